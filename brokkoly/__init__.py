@@ -4,6 +4,7 @@ import json
 import logging
 import os
 import sqlite3
+import time
 import types
 from typing import (
     Any,
@@ -16,14 +17,28 @@ from typing import (
 )
 
 import celery
+import celery.exceptions
+import celery.result
+import celery.signals
 import falcon
 import falcon.request
 import falcon.response
 import jinja2
 
+import brokkoly.aio
+import brokkoly.batch
+import brokkoly.blob
+import brokkoly.circuit
+import brokkoly.coalesce
+import brokkoly.hook
+import brokkoly.priority
 import brokkoly.retry
 import brokkoly.database
+import brokkoly.dead_letter
 import brokkoly.resource
+import brokkoly.sampling
+import brokkoly.scheduler
+import brokkoly.serializer
 
 
 __all__ = ['BrokkolyError', 'Brokkoly', 'producer']
@@ -33,7 +48,7 @@ __credits__ = ["Motoki Naruse"]
 __email__ = "motoki@naru.se"
 __license__ = "MIT"
 __maintainer__ = "Motoki Naruse"
-__version__ = "0.3.1"
+__version__ = "0.4.0"
 
 
 Validation = List[Tuple[str, Any]]
@@ -41,6 +56,13 @@ Processor = collections.namedtuple('Processor', ['func', 'validation'])
 Message = Dict[str, Any]
 
 _tasks = collections.defaultdict(dict)  # type: collections.defaultdict
+# Options of tasks which producer needs. The same structure as _tasks.
+_task_options = collections.defaultdict(dict)  # type: collections.defaultdict
+
+MESSAGE_LOG_PAGE_SIZE = 100
+DEAD_LETTER_PAGE_SIZE = 100
+# Maximum number of dead letters requeued by a request.
+DEAD_LETTER_REQUEUE_LIMIT = 1000
 
 
 logger = logging.getLogger(__name__)
@@ -60,49 +82,361 @@ def copy_function(function: Callable, name: str) -> Callable:
     )
 
 
+def _republish(
+        celery_task, retry_policy: brokkoly.retry.RetryPolicy, serializer: str,
+        kwargs: Dict[str, Any], retries: int, error: Exception, lane: Optional[str]=None
+) -> bool:
+    """Publish the message again for retry, where Task.retry cannot be used.
+
+    Return False if max_retries is exceeded.
+
+    :param lane: If it is not None, the message goes back to the priority lane.
+    """
+    if retry_policy.max_retries is not None and retries >= retry_policy.max_retries:
+        return False
+    celery_task.apply_async(
+        kwargs=kwargs,
+        serializer=serializer,
+        compression='zlib',
+        countdown=retry_policy.countdown(retries, error),
+        retries=retries + 1,
+        headers={brokkoly.hook.PUBLISHED_AT_HEADER: time.time()},
+        **({'queue': lane} if lane else {})
+    )
+    return True
+
+
+def _defer(
+        celery_task, serializer: str, kwargs: Dict[str, Any], retries: int, countdown: int,
+        lane: Optional[str]=None
+) -> None:
+    """Publish the message again without calling the task. It is not counted as a retry.
+    """
+    celery_task.apply_async(
+        kwargs=kwargs,
+        serializer=serializer,
+        compression='zlib',
+        countdown=countdown,
+        retries=retries,
+        headers={brokkoly.hook.PUBLISHED_AT_HEADER: time.time()},
+        **({'queue': lane} if lane else {})
+    )
+
+
+class TaskOptions:
+    def __init__(
+            self, *, serializer: str=brokkoly.serializer.JSON,
+            claim_check: Optional[brokkoly.blob.ClaimCheck]=None,
+            coalesce: Optional[brokkoly.coalesce.Coalesce]=None,
+            sampling: Optional[brokkoly.sampling.Sampling]=None, waitable: bool=False,
+            priority: Optional[brokkoly.priority.Priority]=None
+    ) -> None:
+        """
+        :param waitable: True if the producer can wait for the result of the task.
+        """
+        self.serializer = serializer
+        self.claim_check = claim_check
+        self.coalesce = coalesce
+        self.sampling = sampling or brokkoly.sampling.Always()
+        self.waitable = waitable
+        self.priority = priority
+
+
 class Brokkoly:
-    def __init__(self, name: str, broker: str) -> None:
+    def __init__(
+            self, name: str, broker: str, *, hooks: Iterable[brokkoly.hook.Hook]=(),
+            async_concurrency: int=100,
+            dead_letters: Optional[brokkoly.dead_letter.DeadLetterStore]=None,
+            backend: Optional[str]=None
+    ) -> None:
+        """
+        :param hooks: They wrap every call of tasks on workers. e.g. brokkoly.hook.TimingHook
+        :param async_concurrency: Maximum number of coroutine tasks running at the same time in
+        a worker process.
+        :param dead_letters: If it is not None, messages are stored into it when their tasks fail
+        finally. e.g. brokkoly.dead_letter.DatabaseDeadLetterStore
+        :param backend: Celery result backend. It is required to wait for results on the
+        producer. Use one which notifies results, e.g. redis or rpc, not to poll it.
+        """
         if name.startswith('_'):
             # Because the names is reserved for control.
             raise BrokkolyError("Queue name starting with _ is not allowed.")
-        self.celery = celery.Celery(name, broker=broker)
+        self.name = name
+        self.hooks = list(hooks)
+        self.dead_letters = dead_letters
+        self.celery = celery.Celery(name, broker=broker, backend=backend)
+        self.backend = backend
+        self.event_loop = brokkoly.aio.EventLoopThread(async_concurrency)
+        celery.signals.worker_process_shutdown.connect(
+            lambda **kwargs: self.event_loop.drain(), weak=False)
         self._tasks = _tasks[name]
+        self._task_options = _task_options[name]
 
     def task(
-            self, *preprocessors: Callable, retry_policy: Optional[brokkoly.retry.RetryPolicy]=None
+            self, *preprocessors: Callable,
+            retry_policy: Optional[brokkoly.retry.RetryPolicy]=None,
+            circuit_breaker: Optional[brokkoly.circuit.CircuitBreaker]=None,
+            batch: Optional[brokkoly.batch.Batch]=None,
+            serializer: str=brokkoly.serializer.JSON,
+            claim_check: Optional[brokkoly.blob.ClaimCheck]=None,
+            coalesce: Optional[brokkoly.coalesce.Coalesce]=None,
+            sampling: Optional[brokkoly.sampling.Sampling]=None,
+            priority: Optional[brokkoly.priority.Priority]=None
     ) -> Callable:
         """Return a function for register a function as Celery task.
 
         :param preprocessors: returning value of a preprocessor will be passed to the next
         preprocessor, then all preprocessors are finished, the last result will be passed to
-        function f.
+        function f. Both of them can be coroutine functions.
         :param retry_policy: If it is not None, when an exception is raised by function f, it will
         be retried based on this policy.
+        :param circuit_breaker: If it is not None, while function f keeps failing, messages are
+        deferred with countdown instead of calling function f.
+        :param batch: If it is not None, the worker buffers messages and function f receives a list
+        of messages instead of keyword arguments. Messages are validated with its message_type.
+        :param serializer: Serializer of messages in the broker. "json" or "msgpack".
+        :param claim_check: If it is not None, large messages are put into its blob store and
+        the broker has only references. The blob is deleted when function f succeeds.
+        :param coalesce: If it is not None, the producer merges messages having the same key and
+        publishes one message per window.
+        :param sampling: Which messages are written into message logs. All messages by default.
+        e.g. brokkoly.sampling.OneInN(100)
+        :param priority: If it is not None, messages can have "priority" and they go to the lane
+        of the priority. Workers consume lanes in the ratio of their weights.
         """
+        brokkoly.serializer.check(serializer)
+        if serializer not in self.celery.conf.accept_content:
+            self.celery.conf.accept_content = list(self.celery.conf.accept_content) + [serializer]
+
         def wrapper(f: Callable) -> Callable:
             """Register the function as Celery task.
             """
             if f.__name__ in self._tasks:
                 raise BrokkolyError("{} is already registered.".format(f.__name__))
+            if batch and inspect.iscoroutinefunction(f):
+                raise BrokkolyError("Batch option doesn't support coroutine functions.")
+            # The message is acknowledged when its coroutine is submitted, before it runs.
+            if inspect.iscoroutinefunction(f) and self.celery.conf.task_acks_late:
+                raise BrokkolyError("Coroutine functions don't support task_acks_late.")
+
+            def lane_of(request) -> Optional[str]:
+                # Messages published by workers go back to the lane which they came from.
+                return brokkoly.priority.lane_of(request) if priority else None
 
             def handle(celery_task, *args, **kwargs) -> None:
+                invocation = brokkoly.hook.invocation_of(
+                    self.name, f.__name__, celery_task.request)
+                if circuit_breaker and not circuit_breaker.allow():
+                    _defer(
+                        celery_task, serializer, kwargs, invocation.retries,
+                        circuit_breaker.countdown(), lane_of(celery_task.request)
+                    )
+                    return
                 try:
-                    return f(*args, **kwargs)
+                    with brokkoly.hook.run(self.hooks, invocation):
+                        result = f(
+                            *args, **brokkoly.blob.check_out(claim_check, serializer, kwargs))
                 except Exception as e:
+                    if circuit_breaker:
+                        circuit_breaker.record(False)
                     if not retry_policy:
+                        brokkoly.dead_letter.put(
+                            self.dead_letters, self.name, f.__name__, serializer, kwargs, e,
+                            invocation.retries
+                        )
                         raise e
                     error = e
+                else:
+                    if circuit_breaker:
+                        circuit_breaker.record(True)
+                    brokkoly.blob.discard(claim_check, kwargs)
+                    return result
+
+                if self.dead_letters:
+                    max_retries = retry_policy.max_retries
+                    if max_retries is None:
+                        max_retries = celery_task.max_retries
+                    # Task.retry raises the error instead of retrying.
+                    if max_retries is not None and invocation.retries >= max_retries:
+                        brokkoly.dead_letter.put(
+                            self.dead_letters, self.name, f.__name__, serializer, kwargs, error,
+                            invocation.retries
+                        )
                 celery_task.retry(
                     countdown=retry_policy.countdown(celery_task.request.retries, error),
                     max_retries=retry_policy.max_retries,
                     exc=error
                 )
 
+            def handle_coroutine(celery_task, *args, **kwargs) -> None:
+                """Submit the coroutine and return. The message is delivered at most once, it is
+                lost if the worker process is killed before the coroutine finishes.
+                """
+                invocation = brokkoly.hook.invocation_of(
+                    self.name, f.__name__, celery_task.request, coroutine=True)
+                if circuit_breaker and not circuit_breaker.allow():
+                    _defer(
+                        celery_task, serializer, kwargs, invocation.retries,
+                        circuit_breaker.countdown(), lane_of(celery_task.request)
+                    )
+                    return
+                message = brokkoly.blob.check_out(claim_check, serializer, kwargs)
+
+                async def run() -> None:
+                    try:
+                        with brokkoly.hook.run(self.hooks, invocation):
+                            await f(*args, **message)
+                    except Exception as e:
+                        if circuit_breaker:
+                            circuit_breaker.record(False)
+                        # Nobody waits for the coroutine. Task.retry is not available here.
+                        if not retry_policy or not _republish(
+                                celery_task, retry_policy, serializer, kwargs,
+                                invocation.retries, e, lane_of(celery_task.request)
+                        ):
+                            logger.exception("%s failed: %s", f.__name__, kwargs)
+                            brokkoly.dead_letter.put(
+                                self.dead_letters, self.name, f.__name__, serializer, kwargs, e,
+                                invocation.retries
+                            )
+                    else:
+                        if circuit_breaker:
+                            circuit_breaker.record(True)
+                        brokkoly.blob.discard(claim_check, kwargs)
+
+                self.event_loop.submit(run())
+
+            def call_batch(pairs: List[Tuple[Any, Message]]) -> Optional[Exception]:
+                """Call function f with messages of the pairs, and return its error.
+                """
+                invocation = brokkoly.hook.invocation_of_batch(
+                    self.name, f.__name__, [request for request, _ in pairs])
+                try:
+                    with brokkoly.hook.run(self.hooks, invocation):
+                        f([message for _, message in pairs])
+                except Exception as e:
+                    if circuit_breaker:
+                        circuit_breaker.record(False)
+                    return e
+                if circuit_breaker:
+                    circuit_breaker.record(True)
+                for request, _ in pairs:
+                    brokkoly.blob.discard(claim_check, request.kwargs)
+                return None
+
+            def find_failures(pairs: List[Tuple[Any, Message]], error: Exception) -> List:
+                """Find out messages causing the error of the batch by bisecting it.
+
+                Bisecting stops when both halves fail, e.g. the database is down, and all of
+                their messages are retried. It also stops when the circuit opens. So it calls
+                function f a few times for a batch which fails entirely.
+
+                Return pairs of the request and its error.
+                """
+                if len(pairs) == 1:
+                    return [(pairs[0][0], error)]
+                middle = len(pairs) // 2
+                halves = [pairs[:middle], pairs[middle:]]
+                errors = []  # type: List[Optional[Exception]]
+                for half in halves:
+                    if circuit_breaker and not circuit_breaker.allow():
+                        errors.append(error)
+                    else:
+                        errors.append(call_batch(half))
+                if all(errors):
+                    return [
+                        (request, half_error)
+                        for half, half_error in zip(halves, errors) for request, _ in half
+                    ]
+                failures = []
+                for half, half_error in zip(halves, errors):
+                    if half_error:
+                        failures.extend(find_failures(half, half_error))
+                return failures
+
+            def handle_batch(celery_task, requests) -> None:
+                if circuit_breaker and not circuit_breaker.allow():
+                    countdown = circuit_breaker.countdown()
+                    for request in requests:
+                        _defer(
+                            celery_task, serializer, request.kwargs,
+                            brokkoly.batch.retries_of(request), countdown, lane_of(request)
+                        )
+                    return
+                messages = [
+                    brokkoly.blob.check_out(claim_check, serializer, request.kwargs)
+                    for request in requests
+                ]
+                invocation = brokkoly.hook.invocation_of_batch(self.name, f.__name__, requests)
+                try:
+                    with brokkoly.hook.run(self.hooks, invocation):
+                        result = f(messages)
+                except Exception as e:
+                    if circuit_breaker:
+                        circuit_breaker.record(False)
+                    if not retry_policy:
+                        for request in requests:
+                            brokkoly.dead_letter.put(
+                                self.dead_letters, self.name, f.__name__, serializer,
+                                request.kwargs, e, brokkoly.batch.retries_of(request)
+                            )
+                        raise e
+                    error = e
+                else:
+                    if circuit_breaker:
+                        circuit_breaker.record(True)
+                    for request in requests:
+                        brokkoly.blob.discard(claim_check, request.kwargs)
+                    return result
+
+                if retry_policy.retry_unit == brokkoly.retry.RetryUnit.batch:
+                    failures = [(request, error) for request in requests]
+                else:
+                    failures = find_failures(list(zip(requests, messages)), error)
+
+                exhausted = None
+                for request, error in failures:
+                    if not _republish(
+                            celery_task, retry_policy, serializer, request.kwargs,
+                            brokkoly.batch.retries_of(request), error, lane_of(request)
+                    ):
+                        logger.error("Max retries exceeded: %s %s", request.id, request.kwargs)
+                        brokkoly.dead_letter.put(
+                            self.dead_letters, self.name, f.__name__, serializer, request.kwargs,
+                            error, brokkoly.batch.retries_of(request)
+                        )
+                        exhausted = error
+                if exhausted:
+                    raise exhausted
+
             # Copy handle and give a name because Celery uses the function name. If it is
             # duplicated, can't control which handler will be called.
-            specialized_handle = copy_function(handle, f.__name__)
+            if batch:
+                specialized_handle = copy_function(handle_batch, f.__name__)
+                celery_task = self.celery.task(
+                    specialized_handle, bind=True, **brokkoly.batch.task_options(batch))
+                validation = None  # type: Optional[Validation]
+                if batch.message_type:
+                    validation = _prepare_validation(batch.message_type)
+            else:
+                specialized_handle = copy_function(
+                    handle_coroutine if inspect.iscoroutinefunction(f) else handle, f.__name__)
+                celery_task = self.celery.task(specialized_handle, bind=True)
+                validation = _prepare_validation(f)
+
+            self._task_options[f.__name__] = TaskOptions(
+                serializer=serializer, claim_check=claim_check, coalesce=coalesce,
+                sampling=sampling,
+                # Coroutine tasks return before they finish, and batched tasks have no result
+                # per message. An open circuit defers the message as another task.
+                waitable=bool(self.backend) and not batch and not circuit_breaker and
+                not inspect.iscoroutinefunction(f),
+                priority=priority
+            )
+            if priority:
+                brokkoly.priority.register(self.celery, self.name, f.__name__, priority)
             self._tasks[f.__name__] = (
-                Processor(self.celery.task(specialized_handle, bind=True), _prepare_validation(f)),
+                Processor(celery_task, validation),
                 [
                     Processor(preprocessor, _prepare_validation(preprocessor))
                     for preprocessor in preprocessors
@@ -142,6 +476,85 @@ def _validate(message: Message, validation: Validation) -> Message:
     return validated
 
 
+def _recurse(message: Message, preprocessors: List[Processor]) -> Message:
+    if preprocessors:
+        (preprocess, preprocess_validation), *tail = preprocessors
+        preprocessed = preprocess(**_validate(message, preprocess_validation))
+        if inspect.isawaitable(preprocessed):
+            preprocessed = brokkoly.aio.run(preprocessed)
+        return _recurse(preprocessed, tail)
+    return message
+
+
+def _prepare_kwargs(
+        message: Message, validation: Optional[Validation], preprocessors: List[Processor]
+) -> Dict[str, Any]:
+    """Return keyword arguments for the task from a message.
+    """
+    kwargs = _recurse(message, preprocessors)
+    if not isinstance(kwargs, dict):
+        raise falcon.HTTPBadRequest("Invalid message", "message must be a JSON object")
+    if validation is not None:
+        kwargs = _validate(kwargs, validation)
+    return kwargs
+
+
+def _validate_queue_and_task(
+        queue_name: str, task_name: str) -> Tuple[Processor, List[Processor]]:
+    # _tasks is defaultdict, it deoesn't raise KeyError.
+    if queue_name not in _tasks:
+        raise falcon.HTTPBadRequest(
+            "Undefined queue", "{} is undefined queue".format(queue_name))
+    queue_tasks = _tasks[queue_name]
+
+    try:
+        return queue_tasks[task_name]
+    except KeyError:
+        raise falcon.HTTPBadRequest("Undefined task", "{} is undefined task".format(task_name))
+
+
+def _list_message_logs(
+        req: falcon.request.Request, queue_name: str, task_name: str
+) -> Tuple[List[brokkoly.database.MessageLog], Optional[int]]:
+    """Return a page of message logs and the id for the next page.
+
+    Messages are filtered by query parameter "q", and "before" is used for pagination.
+    """
+    text = req.get_param('q')
+    before = req.get_param_as_int('before')
+    if text:
+        message_logs = list(brokkoly.database.MessageLog.search(
+            queue_name, task_name, text, before=before, limit=MESSAGE_LOG_PAGE_SIZE))
+    else:
+        message_logs = list(brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+            queue_name, task_name, before=before, limit=MESSAGE_LOG_PAGE_SIZE))
+
+    if len(message_logs) < MESSAGE_LOG_PAGE_SIZE:
+        return message_logs, None
+    return message_logs, message_logs[-1].id
+
+
+def _publish(
+        queue_name: str, task_name: str, kwargs: Dict[str, Any], countdown: int=0,
+        priority: Optional[int]=None
+) -> celery.result.AsyncResult:
+    """
+    :param priority: If the task has priority option, the message goes to the lane of it. The
+    default priority if it is None.
+    """
+    (task, _), _ = _tasks[queue_name][task_name]
+    options = _task_options[queue_name][task_name]
+    routing = {}  # type: Dict[str, Any]
+    if options.priority:
+        routing['queue'] = brokkoly.priority.lane(
+            queue_name, task_name, options.priority.default if priority is None else priority)
+    return task.apply_async(
+        kwargs=brokkoly.blob.check_in(options.claim_check, options.serializer, kwargs),
+        serializer=options.serializer, compression='zlib', countdown=countdown,
+        headers={brokkoly.hook.PUBLISHED_AT_HEADER: time.time()}, **routing
+    )
+
+
 class HTMLRendler:
     def __init__(self) -> None:
         self._jinja2 = jinja2.Environment(loader=jinja2.ChoiceLoader([
@@ -152,66 +565,156 @@ class HTMLRendler:
         ])
         self._jinja2.filters['pretty_print_json'] = lambda source: json.dumps(
             json.loads(source), indent=4, sort_keys=True)
+        self._jinja2.filters['to_json'] = brokkoly.serializer.to_json
 
     def render(self, template: str, **kwargs) -> str:
         return self._jinja2.get_template(template).render(**kwargs)
 
 
 class Producer:
-    def __init__(self, rendler: HTMLRendler) -> None:
+    def __init__(
+            self, rendler: HTMLRendler,
+            scheduler: Optional[brokkoly.scheduler.DelayScheduler]=None,
+            coalescer: Optional[brokkoly.coalesce.Coalescer]=None, max_wait: float=30
+    ) -> None:
+        """
+        :param max_wait: Maximum seconds of "wait" query parameter.
+        """
         self._rendler = rendler
-
-    def _recurse(self, message: Message, preprocessors: List[Processor]) -> Message:
-        if preprocessors:
-            (preprocess, preprocess_validation), *tail = preprocessors
-            return self._recurse(preprocess(**_validate(message, preprocess_validation)), tail)
-        return message
+        self._scheduler = scheduler
+        self._coalescer = coalescer
+        self._max_wait = max_wait
 
     def _validate_queue_and_task(
             self, queue_name: str, task_name: str) -> Tuple[Processor, List[Processor]]:
-        # _tasks is defaultdict, it deoesn't raise KeyError.
-        if queue_name not in _tasks:
-            raise falcon.HTTPBadRequest(
-                "Undefined queue", "{} is undefined queue".format(queue_name))
-        queue_tasks = _tasks[queue_name]
-
-        try:
-            return queue_tasks[task_name]
-        except KeyError:
-            raise falcon.HTTPBadRequest("Undefined task", "{} is undefined task".format(task_name))
+        return _validate_queue_and_task(queue_name, task_name)
 
     def _validate_payload(self, req: falcon.request.Request) -> Dict[str, Any]:
-        payload = req.stream.read().decode()
+        payload = req.stream.read()
         if not payload:
             raise falcon.HTTPBadRequest(
                 "Empty payload",
                 "Even your task doesn't need any arguments, payload must have message filed"
             )
+        serializer = brokkoly.serializer.serializer_for(req.content_type)
         try:
-            return json.loads(payload)
+            loaded = brokkoly.serializer.loads(serializer, payload)
         except ValueError:  # Python 3.4 doesn't have json.JSONDecodeError
+            if serializer == brokkoly.serializer.MSGPACK:
+                raise falcon.HTTPBadRequest(
+                    "Payload is not a MessagePack", "The payload must be a MessagePack")
             raise falcon.HTTPBadRequest("Payload is not a JSON", "The payload must be a JSON")
+        if not isinstance(loaded, dict):
+            raise falcon.HTTPBadRequest("Invalid JSON", "JSON must be an object")
+        return loaded
+
+    def _enqueue(
+            self, queue_name: str, task_name: str, kwargs: Dict[str, Any], delay: int,
+            options: TaskOptions, wait: Optional[float], priority: Any
+    ) -> Optional[celery.result.AsyncResult]:
+        """Return the result of the published message if the producer waits for it.
+        """
+        if priority is not None:
+            if not options.priority:
+                raise falcon.HTTPBadRequest(
+                    "Invalid priority", "{} doesn't support priority".format(task_name))
+            try:
+                priority = options.priority.check(priority)
+            except ValueError as e:
+                raise falcon.HTTPBadRequest("Invalid priority", str(e))
+            # The producer holds them without the priority.
+            if (options.coalesce and self._coalescer) or (
+                    self._scheduler and delay > self._scheduler.threshold):
+                raise falcon.HTTPBadRequest(
+                    "Invalid priority", "priority doesn't support coalesce and long delay")
+
+        if wait is not None:
+            if not options.waitable:
+                raise falcon.HTTPBadRequest(
+                    "Invalid wait", "{} doesn't support wait".format(task_name))
+            if not 0 < wait <= self._max_wait:
+                raise falcon.HTTPBadRequest(
+                    "Invalid wait", "wait must be more than 0 and up to {}".format(
+                        self._max_wait))
+            if delay or (options.coalesce and self._coalescer):
+                raise falcon.HTTPBadRequest(
+                    "Invalid wait", "wait doesn't support delay and coalesce")
+            return _publish(queue_name, task_name, kwargs, priority=priority)
+
+        if options.coalesce and self._coalescer:
+            if delay:
+                raise falcon.HTTPBadRequest(
+                    "Invalid delay", "{} doesn't support delay".format(task_name))
+            self._coalescer.add(
+                options.coalesce, queue_name, task_name, kwargs, serializer=options.serializer)
+        elif self._scheduler and delay > self._scheduler.threshold:
+            self._scheduler.schedule(
+                queue_name, task_name, kwargs, delay, serializer=options.serializer)
+        else:
+            _publish(queue_name, task_name, kwargs, countdown=delay, priority=priority)
+        return None
+
+    def _respond_result(
+            self, resp: falcon.response.Response, async_result: celery.result.AsyncResult,
+            wait: float
+    ) -> None:
+        try:
+            # The result backend notifies the result, e.g. Redis pub/sub, so this doesn't poll.
+            result = async_result.get(timeout=wait, propagate=False)
+        except celery.exceptions.TimeoutError:
+            resp.status = falcon.HTTP_202
+            resp.body = json.dumps({'task_id': async_result.id})
+            return
+
+        body = {'task_id': async_result.id, 'status': async_result.state}
+        if async_result.failed():
+            body['error'] = "{}: {}".format(type(result).__name__, result)
+        else:
+            body['result'] = result
+        resp.status = falcon.HTTP_200
+        resp.body = brokkoly.serializer.to_json(body)
 
     def on_post(
             self, req: falcon.request.Request, resp: falcon.response.Response, queue_name: str,
             task_name: str
     ) -> None:
-        (task, validation), preprocessors = self._validate_queue_and_task(queue_name, task_name)
-        payload = self._validate_payload(req)
-
+        message = None
         try:
-            message = payload['message']
-        except KeyError:
-            raise falcon.HTTPBadRequest("Invalid JSON", "JSON must have message field")
-
-        task.apply_async(
-            kwargs=_validate(self._recurse(message, preprocessors), validation),
-            serializer='json',
-            compression='zlib',
-            countdown=payload.get('delay', 0)
-        )
-        brokkoly.database.MessageLog.create(queue_name, task_name, json.dumps(message))
-        brokkoly.database.MessageLog.eliminate(queue_name, task_name)
+            (task, validation), preprocessors = self._validate_queue_and_task(
+                queue_name, task_name)
+            payload = self._validate_payload(req)
+
+            try:
+                message = payload['message']
+            except KeyError:
+                raise falcon.HTTPBadRequest("Invalid JSON", "JSON must have message field")
+
+            options = _task_options[queue_name][task_name]
+            wait = req.get_param_as_float('wait')
+            async_result = self._enqueue(
+                queue_name, task_name, _prepare_kwargs(message, validation, preprocessors),
+                payload.get('delay', 0), options, wait, payload.get('priority')
+            )
+        except falcon.HTTPBadRequest as e:
+            # They are logged regardless of sampling, because message logs don't have them.
+            logger.warning(
+                "Rejected %s/%s: %s %s", queue_name, task_name, e.description,
+                brokkoly.serializer.to_json(message)
+            )
+            raise
+        except Exception:
+            logger.exception(
+                "Failed to publish %s/%s: %s", queue_name, task_name,
+                brokkoly.serializer.to_json(message)
+            )
+            raise
+        options.sampling.log(queue_name, task_name, message, options.serializer)
+        if async_result is not None:
+            # Don't hold the lock of the database while waiting.
+            for connection in [brokkoly.database.db.get()] + brokkoly.database.db.get_shards():
+                connection.commit()  # type: ignore
+            self._respond_result(resp, async_result, wait)  # type: ignore
+            return
         resp.status = falcon.HTTP_202
         resp.body = "{}"
 
@@ -220,12 +723,117 @@ class Producer:
             task_name: str
     ) -> None:
         self._validate_queue_and_task(queue_name, task_name)
-        messages = brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
-            queue_name, task_name)
+        messages, next_before = _list_message_logs(req, queue_name, task_name)
 
         resp.content_type = 'text/html'
         resp.body = self._rendler.render(
-            "enqueue.html", queue_name=queue_name, task_name=task_name, messages=messages)
+            "enqueue.html", queue_name=queue_name, task_name=task_name, messages=messages,
+            text=req.get_param('q'), next_before=next_before
+        )
+
+
+class MessageLogResource:
+    def on_get(
+            self, req: falcon.request.Request, resp: falcon.response.Response, queue_name: str,
+            task_name: str
+    ) -> None:
+        _validate_queue_and_task(queue_name, task_name)
+        messages, next_before = _list_message_logs(req, queue_name, task_name)
+
+        resp.body = json.dumps({
+            'messages': [{
+                'id': message.id,
+                'message': json.loads(message.message),
+                'created_at': message.created_at,
+            } for message in messages],
+            'next_before': next_before,
+        })
+
+
+class DeadLetterResource:
+    def __init__(self, rendler: HTMLRendler) -> None:
+        self._rendler = rendler
+
+    def on_get(
+            self, req: falcon.request.Request, resp: falcon.response.Response, queue_name: str,
+            task_name: str
+    ) -> None:
+        """Return dead letters from newer one with their counts by error type.
+
+        They are filtered by query parameter "error_type", and "before" is used for pagination.
+        HTML is returned for browsers.
+        """
+        _validate_queue_and_task(queue_name, task_name)
+        error_type = req.get_param('error_type')
+        dead_letters = [{
+            'id': dead_letter.id,
+            'message': brokkoly.serializer.loads(dead_letter.serializer, dead_letter.message),
+            'error_type': dead_letter.error_type,
+            'error': dead_letter.error,
+            'retries': dead_letter.retries,
+            'created_at': dead_letter.created_at,
+        } for dead_letter in brokkoly.database.DeadLetter.list_by_queue_name_and_task_name(
+            queue_name, task_name, error_type=error_type,
+            before=req.get_param_as_int('before'), limit=DEAD_LETTER_PAGE_SIZE
+        )]
+        groups = [
+            {'error_type': group_error_type, 'count': count}
+            for group_error_type, count in brokkoly.database.DeadLetter.count_by_error_type(
+                queue_name, task_name)
+        ]
+        next_before = dead_letters[-1]['id'] if len(
+            dead_letters) == DEAD_LETTER_PAGE_SIZE else None
+
+        if req.client_prefers(['application/json', 'text/html']) == 'text/html':
+            resp.content_type = 'text/html'
+            resp.body = self._rendler.render(
+                "dead_letters.html", queue_name=queue_name, task_name=task_name,
+                dead_letters=dead_letters, groups=groups, error_type=error_type,
+                next_before=next_before, static_root="../.."
+            )
+            return
+
+        resp.body = brokkoly.serializer.to_json({
+            'groups': groups,
+            'dead_letters': dead_letters,
+            'next_before': next_before,
+        })
+
+
+class DeadLetterRequeueResource:
+    def __init__(self, rate: Optional[float]) -> None:
+        """
+        :param rate: Maximum number of messages per second.
+        """
+        self._rate = rate
+
+    def on_post(
+            self, req: falcon.request.Request, resp: falcon.response.Response, queue_name: str,
+            task_name: str
+    ) -> None:
+        """Requeue dead letters. The payload can have "ids" or "error_type" to choose them.
+        """
+        _validate_queue_and_task(queue_name, task_name)
+        try:
+            payload = json.loads(req.stream.read().decode() or "{}")
+        except ValueError:
+            raise falcon.HTTPBadRequest("Payload is not a JSON", "The payload must be a JSON")
+        if not isinstance(payload, dict):
+            raise falcon.HTTPBadRequest("Invalid JSON", "JSON must be an object")
+
+        ids = payload.get('ids')
+        if ids is not None and not (
+                isinstance(ids, list) and all(isinstance(id, int) for id in ids)):
+            raise falcon.HTTPBadRequest("Invalid type", "ids must be a list of int")
+        error_type = payload.get('error_type')
+        if error_type is not None and not isinstance(error_type, str):
+            raise falcon.HTTPBadRequest("Invalid type", "error_type must be str")
+
+        requeued = brokkoly.dead_letter.requeue(
+            queue_name, task_name, ids=ids, error_type=error_type, rate=self._rate,
+            limit=DEAD_LETTER_REQUEUE_LIMIT
+        )
+        resp.body = json.dumps({'requeued': requeued})
 
 
 class TaskListResource:
@@ -301,16 +909,19 @@ class DBManager:
             # make connection only requested URL is matched any route.
             return
 
+        connections = [connection] + list(self.connection_manager.get_shards())
         if req_succeeded:
-            connection.commit()
-            connection.close()
+            for connection in connections:
+                connection.commit()
+                connection.close()
             return
 
         # I think no way to know the connection is alive or not. When the thread is reused, and
         # it was passed process_resource method, connection is not None and comes here.
         try:
-            connection.rollback()
-            connection.close()
+            for connection in connections:
+                connection.rollback()
+                connection.close()
         except sqlite3.ProgrammingError:
             # With above reason, I think we don't need to report this one as exception.
             logger.debug("Failed to rollback or close SQLite3 connection.")
@@ -323,17 +934,67 @@ def init_logger(log_level: int) -> None:
     )
 
 
-def producer(*, path: Optional[str]=None, log_level=logging.ERROR) -> falcon.api.API:
+def producer(
+        *, path: Optional[str]=None, log_level=logging.ERROR, delay_threshold: Optional[int]=None,
+        database: str="brokkoly.db", shard_message_logs: bool=False,
+        snapshot: Optional[str]=None, snapshot_interval: int=60,
+        dead_letter_requeue_rate: Optional[float]=100, max_wait: float=30
+) -> falcon.api.API:
+    """Return WSGI application.
+
+    :param delay_threshold: If it is not None, messages having longer delay (seconds) than this
+    are held by the producer and published when they are due instead of Celery's countdown.
+    :param database: Path to the SQLite3 database, for example on tmpfs. If it is ":memory:", the
+    database is in a temporary directory on tmpfs (/dev/shm), removed when the process exits.
+    :param shard_message_logs: If it is True, message logs are stored in a database file per
+    queue, next to the database. e.g. brokkoly.{queue_name}.db
+    :param snapshot: Only for ":memory:". In-memory databases are loaded from this path on
+    start, and written into it every snapshot_interval seconds.
+    :param dead_letter_requeue_rate: Maximum number of dead letters requeued per second. If it is
+    None, no limit.
+    :param max_wait: Maximum seconds which a request waits for the result with "wait" query
+    parameter. The WSGI thread is occupied while waiting.
+    """
     init_logger(log_level)
-    brokkoly.database.db.dbname = "brokkoly.db"
+    brokkoly.database.db.dbname = database
+    brokkoly.database.db.shard_message_logs = shard_message_logs
+
+    if snapshot:
+        if database != brokkoly.database.MEMORY:
+            raise BrokkolyError("snapshot is only for in-memory database.")
+        brokkoly.database.db.restore(snapshot)
+        brokkoly.database.Snapshotter(brokkoly.database.db, snapshot, snapshot_interval).start()
 
     brokkoly.database.Migrator(__version__).migrate()
 
+    scheduler = None
+    if delay_threshold is not None:
+        scheduler = brokkoly.scheduler.DelayScheduler(delay_threshold, _publish)
+        scheduler.start()
+
+    coalescer = None
+    if any(
+            options.coalesce
+            for queue_task_options in _task_options.values()
+            for options in queue_task_options.values()
+    ):
+        coalescer = brokkoly.coalesce.Coalescer(_publish)
+        coalescer.start()
+
     application = falcon.API(middleware=[DBManager(brokkoly.database.db)])
     rendler = HTMLRendler()
     for controller, route in [
             (StaticResource(), "/__static__/{filename}"),
-            (Producer(rendler), "/{queue_name}/{task_name}"),
+            (
+                Producer(rendler, scheduler, coalescer, max_wait=max_wait),
+                "/{queue_name}/{task_name}"
+            ),
+            (MessageLogResource(), "/{queue_name}/{task_name}/messages"),
+            (DeadLetterResource(rendler), "/{queue_name}/{task_name}/dead_letters"),
+            (
+                DeadLetterRequeueResource(dead_letter_requeue_rate),
+                "/{queue_name}/{task_name}/dead_letters/requeue"
+            ),
             (QueueListResource(rendler), "/"),
             (TaskListResource(rendler), "/{queue_name}"),
     ]:
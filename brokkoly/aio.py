@@ -0,0 +1,77 @@
+"""Support of coroutine functions as tasks and preprocessors.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import threading
+from typing import (  # NOQA
+    Any,
+    Optional,
+    Set,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """Event loop running in a daemon thread of the worker process.
+
+    Task calls return as soon as their coroutines are submitted, so a worker process runs many
+    coroutines at the same time. When the number of running coroutines reaches concurrency,
+    submitting blocks until one of them finishes.
+    """
+
+    def __init__(self, concurrency: int) -> None:
+        self.concurrency = concurrency
+        self._pid = None  # type: Optional[int]
+        self._loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        self._semaphore = None  # type: Optional[threading.BoundedSemaphore]
+        self._in_flight = set()  # type: Set[concurrent.futures.Future]
+
+    def _start(self) -> None:
+        # Threads are not inherited by forked worker processes, so start it in each process.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = threading.BoundedSemaphore(self.concurrency)
+        self._in_flight = set()
+        threading.Thread(
+            target=self._loop.run_forever, name="brokkoly-event-loop", daemon=True).start()
+
+    def submit(self, coroutine: Any) -> concurrent.futures.Future:
+        self._start()
+        self._semaphore.acquire()  # type: ignore
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)  # type: ignore
+        self._in_flight.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: concurrent.futures.Future) -> None:
+        self._in_flight.discard(future)
+        self._semaphore.release()  # type: ignore
+
+    def drain(self, timeout: Optional[float]=None) -> None:
+        """Wait for running coroutines. It is called when the worker process shuts down.
+        """
+        if self._pid != os.getpid() or not self._in_flight:
+            return
+        _, not_done = concurrent.futures.wait(list(self._in_flight), timeout=timeout)
+        if not_done:
+            logger.warning("%d coroutines are not finished.", len(not_done))
+
+
+_local = threading.local()
+
+
+def run(coroutine: Any) -> Any:
+    """Run the coroutine on the event loop of the current thread and return its result.
+
+    It is for preprocessors which are called by WSGI threads.
+    """
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        loop = _local.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
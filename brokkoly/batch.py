@@ -0,0 +1,49 @@
+import collections
+import logging
+from typing import (  # NOQA
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+try:
+    import celery_batches
+except ImportError:  # pragma: no cover
+    celery_batches = None
+
+import brokkoly
+
+
+logger = logging.getLogger(__name__)
+
+
+# max_size: The task is called when this number of messages are buffered.
+# max_wait: Seconds. The task is called even the buffer doesn't reach max_size.
+# message_type: A function whose arguments define a message, in the same way as tasks. The
+# producer validates messages with it. If it is None, messages are validated only by
+# preprocessors.
+Batch = collections.namedtuple('Batch', ['max_size', 'max_wait', 'message_type'])
+Batch.__new__.__defaults__ = (None, )  # type: ignore
+
+
+def task_options(batch: Batch) -> Dict[str, Any]:
+    """Return options for Celery.task to register a batched task.
+    """
+    if celery_batches is None:
+        raise brokkoly.BrokkolyError(
+            "celery-batches is required for batch option. Install brokkoly[batch].")
+
+    return {
+        'base': celery_batches.Batches,
+        'flush_every': batch.max_size,
+        'flush_interval': batch.max_wait,
+        # Acknowledge after the whole batch is processed.
+        'acks_late': True,
+    }
+
+
+def retries_of(request) -> int:
+    """Return how many times the buffered request has been retried.
+    """
+    return (request.request_dict or {}).get('retries') or 0
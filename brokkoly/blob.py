@@ -0,0 +1,113 @@
+import abc
+import contextlib
+import mmap
+import os
+import uuid
+from typing import (  # NOQA
+    Any,
+    Dict,
+    Iterator,
+    Optional,
+)
+
+import brokkoly.serializer
+
+
+# The message in the broker has only this key when its payload is in a blob store.
+CLAIM_CHECK_KEY = '__brokkoly_claim_check__'
+
+
+class BlobStore(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def put(self, data: bytes) -> str:
+        """Return the key for the data.
+        """
+        ...
+
+    @abc.abstractmethod
+    def open(self, key: str) -> Any:
+        """Return a context manager giving a bytes-like object.
+        """
+        ...
+
+    @abc.abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+
+class FileSystemBlobStore(BlobStore):
+    """Store blobs as files. Use a shared mount if workers run on other hosts.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def put(self, data: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        key = uuid.uuid4().hex
+        # Workers must not see a file being written.
+        temporary = self._path('.' + key)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.rename(temporary, self._path(key))
+        return key
+
+    @contextlib.contextmanager
+    def open(self, key: str) -> Iterator[Any]:
+        with open(self._path(key), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                # Empty file cannot be mapped.
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class ClaimCheck:
+    def __init__(self, threshold: int, store: Optional[BlobStore]=None) -> None:
+        """
+        :param threshold: Bytes. Larger serialized message than this is put into the store.
+        :param store: The default is FileSystemBlobStore on "brokkoly_blobs" directory.
+        """
+        self.threshold = threshold
+        self.store = store or FileSystemBlobStore("brokkoly_blobs")
+
+
+def check_in(
+        claim_check: Optional[ClaimCheck], serializer: str, kwargs: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Return kwargs for the broker. It is a reference if the message is large.
+    """
+    if not claim_check:
+        return kwargs
+    data = brokkoly.serializer.dumps(serializer, kwargs)
+    if len(data) <= claim_check.threshold:
+        return kwargs
+    return {CLAIM_CHECK_KEY: claim_check.store.put(data)}
+
+
+def check_out(
+        claim_check: Optional[ClaimCheck], serializer: str, kwargs: Dict[str, Any]
+) -> Dict[str, Any]:
+    """Return the original kwargs of the kwargs from the broker.
+    """
+    if not claim_check or CLAIM_CHECK_KEY not in kwargs:
+        return kwargs
+    with claim_check.store.open(kwargs[CLAIM_CHECK_KEY]) as buffer:
+        return brokkoly.serializer.loads(serializer, buffer)
+
+
+def discard(claim_check: Optional[ClaimCheck], kwargs: Dict[str, Any]) -> None:
+    """Delete the blob after the message is processed.
+    """
+    if claim_check and CLAIM_CHECK_KEY in kwargs:
+        claim_check.store.delete(kwargs[CLAIM_CHECK_KEY])
@@ -0,0 +1,129 @@
+import collections
+import enum
+import threading
+import time
+from typing import (  # NOQA
+    Deque,
+    List,
+)
+
+import brokkoly
+
+
+State = enum.Enum('State', ['closed', 'open', 'half_open'])  # type: ignore
+
+
+class CircuitBreaker:
+    """Stop calling a task while it keeps failing.
+
+    The circuit opens when the failure rate in the last window seconds exceeds failure_rate. While
+    it is open, messages are not called but published again with countdown until the circuit
+    becomes half-open. Then probes messages are called, and the circuit closes if all of them
+    succeed, or opens again if one of them fails.
+
+    Each worker process has its own state.
+    """
+
+    def __init__(
+            self, *, failure_rate: float=0.5, window: int=60, min_calls: int=10,
+            open_for: int=60, probes: int=1
+    ) -> None:
+        """
+        :param failure_rate: 0 to 1.
+        :param window: Seconds of the sliding window.
+        :param min_calls: The circuit doesn't open until the window has this number of calls.
+        :param open_for: Seconds to keep the circuit open.
+        :param probes: Number of calls in half-open state.
+        """
+        if not 0 < failure_rate <= 1:
+            raise brokkoly.BrokkolyError("failure_rate must be in (0, 1].")
+        self.failure_rate = failure_rate
+        self.window = window
+        self.min_calls = min_calls
+        self.open_for = open_for
+        self.probes = probes
+        self._lock = threading.Lock()
+        self._state = State.closed  # type: ignore
+        # When the circuit opened, or when the last probes started.
+        self._opened_at = 0.0
+        self._probing = 0
+        self._succeeded_probes = 0
+        # Counters per second: [second, calls, failures]
+        self._buckets = collections.deque()  # type: Deque[List[int]]
+        self._calls = 0
+        self._failures = 0
+
+    @property
+    def state(self) -> State:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> State:
+        # Probes may never finish, e.g. the worker was killed. Start new probes in that case.
+        if self._state != State.closed and now - self._opened_at >= self.open_for:  # type: ignore
+            self._state = State.half_open  # type: ignore
+            self._opened_at = now
+            self._probing = self._succeeded_probes = 0
+        return self._state
+
+    def _open(self, now: float) -> None:
+        self._state = State.open  # type: ignore
+        self._opened_at = now
+        self._buckets.clear()
+        self._calls = self._failures = 0
+
+    def allow(self) -> bool:
+        """Return False if the message should be deferred.
+        """
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == State.closed:  # type: ignore
+                return True
+            if state == State.half_open and self._probing < self.probes:  # type: ignore
+                self._probing += 1
+                return True
+            return False
+
+    def countdown(self) -> int:
+        """Return seconds to defer a message until the circuit becomes half-open.
+        """
+        with self._lock:
+            remaining = self.open_for - (time.monotonic() - self._opened_at)
+        return max(int(remaining) + 1, 1)
+
+    def record(self, succeeded: bool) -> None:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == State.half_open:  # type: ignore
+                if not succeeded:
+                    self._open(now)
+                    return
+                self._succeeded_probes += 1
+                if self._succeeded_probes >= self.probes:
+                    self._state = State.closed  # type: ignore
+                return
+            if state == State.open:  # type: ignore
+                # Calls which were allowed before the circuit opened.
+                return
+
+            second = int(now)
+            if self._buckets and self._buckets[-1][0] == second:
+                bucket = self._buckets[-1]
+            else:
+                bucket = [second, 0, 0]
+                self._buckets.append(bucket)
+            bucket[1] += 1
+            bucket[2] += 0 if succeeded else 1
+            self._calls += 1
+            self._failures += 0 if succeeded else 1
+            while self._buckets[0][0] <= second - self.window:
+                _, calls, failures = self._buckets.popleft()
+                self._calls -= calls
+                self._failures -= failures
+
+            if (
+                    self._calls >= self.min_calls and
+                    self._failures / self._calls >= self.failure_rate
+            ):
+                self._open(now)
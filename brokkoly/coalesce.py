@@ -0,0 +1,195 @@
+import contextlib
+import logging
+import threading
+import time
+from typing import (  # NOQA
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    List,
+    Optional,
+    Tuple,
+)
+
+import brokkoly.database
+import brokkoly.serializer
+
+
+logger = logging.getLogger(__name__)
+
+
+Kwargs = Dict[str, Any]
+Merge = Callable[[Kwargs, Kwargs], Kwargs]
+
+
+def last_write_wins(old: Kwargs, new: Kwargs) -> Kwargs:
+    return new
+
+
+class Coalesce:
+    """Merge messages having the same key, and publish one message when the window closes.
+
+    The window starts from the first message of the key.
+    """
+
+    def __init__(
+            self, key: Callable[[Kwargs], Hashable], window: float, *,
+            merge: Merge=last_write_wins, shared: bool=False
+    ) -> None:
+        """
+        :param key: It receives validated kwargs and returns the key of the message.
+        :param window: Seconds.
+        :param merge: It receives the pending kwargs and the new one, and returns merged kwargs.
+        :param shared: If it is True, messages are coalesced across producer processes on the
+        host with the database. Otherwise in the producer process.
+        """
+        self.key = key
+        self.window = window
+        self.merge = merge
+        self.shared = shared
+
+
+class MemoryStore:
+    """A message failed to be published is put back, and published at the next check.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # (queue_name, task_name, key) -> (due_at, kwargs)
+        self._pending = {}  # type: Dict[Tuple[str, str, Hashable], Tuple[float, Kwargs]]
+
+    def add(
+            self, queue_name: str, task_name: str, key: Hashable, kwargs: Kwargs, due_at: float,
+            merge: Merge
+    ) -> None:
+        with self._lock:
+            pending = self._pending.get((queue_name, task_name, key))
+            if pending:
+                self._pending[queue_name, task_name, key] = (
+                    pending[0], merge(pending[1], kwargs))
+            else:
+                self._pending[queue_name, task_name, key] = (due_at, kwargs)
+
+    def pop_due(self, now: float) -> List[Tuple[str, str, Hashable, Kwargs]]:
+        with self._lock:
+            due = [k for k, (due_at, _) in self._pending.items() if due_at <= now]
+            return [(k[0], k[1], k[2], self._pending.pop(k)[1]) for k in due]
+
+    def put_back(
+            self, queue_name: str, task_name: str, key: Hashable, kwargs: Kwargs, due_at: float,
+            merge: Merge
+    ) -> None:
+        """Put back a popped message. Messages added after it was popped are merged into it.
+        """
+        with self._lock:
+            pending = self._pending.get((queue_name, task_name, key))
+            self._pending[queue_name, task_name, key] = (
+                due_at, merge(kwargs, pending[1]) if pending else kwargs)
+
+
+class DatabaseStore:
+    """Messages are updated with compare-and-swap, because other processes may update them.
+
+    Messages are stored with the serializer of the task.
+    """
+
+    def add(
+            self, queue_name: str, task_name: str, key: Hashable, kwargs: Kwargs, due_at: float,
+            merge: Merge, serializer: str
+    ) -> None:
+        while True:
+            pending = brokkoly.database.CoalescedMessage.get(queue_name, task_name, str(key))
+            if pending is None:
+                if brokkoly.database.CoalescedMessage.create(
+                        queue_name, task_name, str(key),
+                        brokkoly.serializer.dumps(serializer, kwargs), serializer, due_at
+                ):
+                    return
+            elif brokkoly.database.CoalescedMessage.replace_message(
+                    pending, brokkoly.serializer.dumps(pending.serializer, merge(
+                        brokkoly.serializer.loads(pending.serializer, pending.message), kwargs))
+            ):
+                return
+
+
+class Coalescer:
+    def __init__(
+            self, publish: Callable[[str, str, Kwargs], None], *, interval: float=0.5
+    ) -> None:
+        """
+        :param publish: It is called with queue name, task name and kwargs when a window closes.
+        :param interval: Seconds to check windows.
+        """
+        self._publish = publish
+        self._interval = interval
+        self._memory_store = MemoryStore()
+        self._database_store = DatabaseStore()
+        # (queue_name, task_name) -> Coalesce, to put back messages of the memory store.
+        self._coalesces = {}  # type: Dict[Tuple[str, str], Coalesce]
+
+    def add(
+            self, coalesce: Coalesce, queue_name: str, task_name: str, kwargs: Kwargs, *,
+            serializer: str=brokkoly.serializer.JSON
+    ) -> None:
+        """
+        :param serializer: Serializer of the task. Shared messages are stored with it.
+        """
+        due_at = time.time() + coalesce.window
+        if coalesce.shared:
+            self._database_store.add(
+                queue_name, task_name, coalesce.key(kwargs), kwargs, due_at, coalesce.merge,
+                serializer
+            )
+        else:
+            self._coalesces[queue_name, task_name] = coalesce
+            self._memory_store.add(
+                queue_name, task_name, coalesce.key(kwargs), kwargs, due_at, coalesce.merge)
+
+    def run_pending(self, now: float) -> None:
+        """Publish messages whose window is closed. This is called by the coalescer thread.
+
+        Messages failed to be published are published again at the next check.
+        """
+        for queue_name, task_name, key, kwargs in self._memory_store.pop_due(now):
+            try:
+                self._publish(queue_name, task_name, kwargs)
+            except Exception:
+                logger.exception("Failed to publish coalesced message: %s", kwargs)
+                self._memory_store.put_back(
+                    queue_name, task_name, key, kwargs, now,
+                    self._coalesces[queue_name, task_name].merge
+                )
+
+        connection = brokkoly.database.db.get()
+        for pending in brokkoly.database.CoalescedMessage.list_due_before(now):
+            # Other producer processes may publish it already, or update it.
+            if not brokkoly.database.CoalescedMessage.delete(pending):
+                connection.rollback()  # type: ignore
+                continue
+            try:
+                self._publish(
+                    pending.queue_name, pending.task_name,
+                    brokkoly.serializer.loads(pending.serializer, pending.message)
+                )
+            except Exception:
+                logger.exception("Failed to publish coalesced message: %s", pending.message)
+                connection.rollback()  # type: ignore
+                continue
+            connection.commit()  # type: ignore
+
+    def _run(self) -> None:
+        while True:
+            brokkoly.database.db.reconnect()
+            with contextlib.closing(brokkoly.database.db.get()):  # type: ignore
+                try:
+                    while True:
+                        self.run_pending(time.time())
+                        time.sleep(self._interval)
+                except Exception:
+                    logger.exception("Coalescer is stopped by error. Restart it.")
+            time.sleep(self._interval)
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self._run, name="brokkoly-coalescer", daemon=True)
+        thread.start()
@@ -1,45 +1,215 @@
+import atexit
 import contextlib
 import datetime
+import json
 import logging
 import os
+import re
+import shutil
 import sqlite3
+import tempfile
 import threading
+import time
 from typing import (  # NOQA
+    Any,
     Dict,
     Iterator,
+    List,
     Optional,
+    Set,
+    Tuple,
 )
 
 import brokkoly.resource
+import brokkoly.serializer
 
 
 logger = logging.getLogger(__name__)
 
+# The largest INTEGER PRIMARY KEY of SQLite3.
+_MAX_ID = 2 ** 63 - 1
+
+
+def _fts_phrase(text: str) -> str:
+    """Search the text as a phrase. FTS5 query syntax is not exposed.
+    """
+    return '"{}"'.format(text.replace('"', '""'))
+
+
+MEMORY = ':memory:'
+
+
+def shard_filename(filename: str, shard: str) -> str:
+    """brokkoly.db -> brokkoly.{shard}.db
+    """
+    root, ext = os.path.splitext(filename)
+    return "{}.{}{}".format(root, re.sub(r'[^\w.-]', '_', shard), ext)
+
 
 class ThreadLocalDBConnectionManager:
-    _connections = {}  # type: Dict[int, sqlite3.Connection]
+    """Connections per thread.
+
+    If shard_message_logs is True, message_logs of each queue are stored in a database file of
+    the queue, so writers of unrelated queues don't wait for the same lock. Connections to the
+    shards are made when they are used first in the thread.
+
+    If dbname is ":memory:", the databases are files in a temporary directory on tmpfs
+    (/dev/shm), which is removed when the process exits. They are not SQLite3 in-memory databases
+    with shared cache, because it locks tables without waiting, and concurrent requests fail.
+    """
+    # thread id -> shard -> connection. Shard None is the main database.
+    _connections = {}  # type: Dict[int, Dict[Optional[str], sqlite3.Connection]]
     dbname = None  # type: Optional[str]
+    shard_message_logs = False
+    # Filenames of shards which are migrated by this process.
+    _migrated_shards = set()  # type: Set[str]
+    # The temporary directory for ":memory:".
+    _memory_directory = None  # type: Optional[str]
+    _memory_directory_lock = threading.Lock()
 
-    def get(self) -> Optional[sqlite3.Connection]:
-        return self._connections.get(threading.get_ident())
+    def _get_memory_directory(self) -> str:
+        with self._memory_directory_lock:
+            if self._memory_directory is None:
+                self._memory_directory = tempfile.mkdtemp(
+                    prefix='brokkoly-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+                atexit.register(_remove_directory, self._memory_directory, os.getpid())
+            return self._memory_directory
 
-    def reconnect(self) -> None:
-        id = threading.get_ident()
-        connection = sqlite3.connect(self.dbname)
+    def _name(self, shard: Optional[str]) -> str:
+        dbname = self.dbname
+        if dbname == MEMORY:
+            dbname = os.path.join(self._get_memory_directory(), 'brokkoly.db')
+        return dbname if shard is None else shard_filename(dbname, shard)  # type: ignore
+
+    def _connect(self, shard: Optional[str]) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._name(shard))
         connection.row_factory = sqlite3.Row
-        logger.debug("Connect sqlite3 (%s) for %s", connection, id)
-        self._connections[id] = connection
+        logger.debug("Connect sqlite3 (%s) for %s", connection, threading.get_ident())
+        return connection
+
+    def get(self, shard: Optional[str]=None) -> Optional[sqlite3.Connection]:
+        """Return the connection for the main database, or for the shard of the queue name.
+        """
+        connections = self._connections.get(threading.get_ident())
+        if connections is None:
+            return None
+        if shard is None or not self.shard_message_logs:
+            return connections[None]
+
+        if shard not in connections:
+            connections[shard] = self._connect(shard)
+            if self._name(shard) not in self._migrated_shards:
+                Migrator(brokkoly.__version__, connections[shard]).migrate()
+                self._migrated_shards.add(self._name(shard))
+        return connections[shard]
+
+    def get_shards(self) -> List[sqlite3.Connection]:
+        """Return connections for shards which the current thread has.
+        """
+        connections = self._connections.get(threading.get_ident(), {})
+        return [connection for shard, connection in connections.items() if shard is not None]
+
+    def reconnect(self) -> None:
+        self._connections[threading.get_ident()] = {None: self._connect(None)}
+
+    def close(self) -> None:
+        for connection in self._connections.pop(threading.get_ident(), {}).values():
+            connection.close()
+
+    def snapshot(self, filename: str) -> None:
+        """Write in-memory databases into files. It can be called by any thread.
+        """
+        for shard, path in _list_databases(self._name(None)):
+            target_filename = filename if shard is None else shard_filename(filename, shard)
+            temporary = target_filename + '.tmp'
+            try:
+                with contextlib.closing(sqlite3.connect(path)) as source, \
+                        contextlib.closing(sqlite3.connect(temporary)) as target:
+                    source.backup(target)
+                os.replace(temporary, target_filename)
+            except BaseException:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temporary)
+                raise
+
+    def restore(self, filename: str) -> None:
+        """Load snapshots into in-memory databases.
+        """
+        for shard, path in _list_databases(filename):
+            with contextlib.closing(self._connect(shard)) as connection, \
+                    contextlib.closing(sqlite3.connect(path)) as source:
+                source.backup(connection)
+
+
+def _list_databases(filename: str) -> Iterator[Tuple[Optional[str], str]]:
+    """Return the shard and the path of the database and its shards.
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    root, ext = os.path.splitext(basename)
+    if not os.path.isdir(directory):
+        return
+    for database in sorted(os.listdir(directory)):
+        if database == basename:
+            shard = None  # type: Optional[str]
+        elif database.startswith(root + '.') and database.endswith(ext) and \
+                len(database) > len(root) + len(ext) + 1:
+            shard = database[len(root) + 1:len(database) - len(ext)]
+        else:
+            continue
+        yield shard, os.path.join(directory, database)
+
+
+def _remove_directory(directory: str, pid: int) -> None:
+    # Forked processes share the directory with the process which made it.
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Snapshotter:
+    """Write in-memory databases into files periodically.
+    """
+
+    def __init__(
+            self, connection_manager: ThreadLocalDBConnectionManager, filename: str,
+            interval: int
+    ) -> None:
+        self.connection_manager = connection_manager
+        self.filename = filename
+        self.interval = interval
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.connection_manager.snapshot(self.filename)
+            except Exception:
+                logger.exception("Failed to take snapshot.")
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self._run, name="brokkoly-snapshotter", daemon=True)
+        thread.start()
+        # Don't lose messages since the last snapshot on normal exit.
+        atexit.register(self.connection_manager.snapshot, self.filename)
 
 
 db = ThreadLocalDBConnectionManager()
 
 
 class Migrator:
-    def __init__(self, brokkoly_version: str) -> None:
+    def __init__(
+            self, brokkoly_version: str, connection: Optional[sqlite3.Connection]=None
+    ) -> None:
+        """
+        :param connection: If it is None, connect to the main database for migration.
+        """
         self.brokkoly_version = brokkoly_version
+        self.connection = connection
+
+    def _get_connection(self) -> sqlite3.Connection:
+        return self.connection or db.get()  # type: ignore
 
     def _has_database(self):
-        with contextlib.closing(db.get().cursor()) as cursor:
+        with contextlib.closing(self._get_connection().cursor()) as cursor:
             cursor.execute("""
             SELECT EXISTS(
                 SELECT * FROM sqlite_master
@@ -51,7 +221,7 @@ class Migrator:
             return cursor.fetchone()[0]
 
     def _get_migration_version(self):
-        with contextlib.closing(db.get().cursor()) as cursor:
+        with contextlib.closing(self._get_connection().cursor()) as cursor:
             cursor.execute("""
             SELECT version
             FROM migrations
@@ -79,27 +249,61 @@ class Migrator:
                 "Brokkoly.".format(self.brokkoly_version, schema_version)
             )
 
+    def _iter_statements(self, sql: str) -> Iterator[str]:
+        """Split the SQL into statements. Transaction control of the file is skipped, because
+        the migration runs in the transaction of _migrate.
+        """
+        statement = ""
+        for line in sql.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                if statement.strip().upper() not in ('BEGIN;', 'COMMIT;'):
+                    yield statement
+                statement = ""
+        if statement.strip():
+            yield statement
+
     def _run_migration_sql_file(self, filename: str) -> None:
         with open(filename, 'r') as f:
             sql = f.read()
 
-        with contextlib.closing(db.get().cursor()) as cursor:
+        with contextlib.closing(self._get_connection().cursor()) as cursor:
             try:
-                cursor.executescript(sql)
+                for statement in self._iter_statements(sql):
+                    cursor.execute(statement)
             except sqlite3.Error as e:
                 logger.exception("Failed to run migration: %s", filename)
                 raise brokkoly.BrokkolyError("Failed to run migration") from e
 
     def _migrate(self) -> None:
-        schema_version = self._get_migration_version() if self._has_database() else '0'
-        logger.info("schema_version: %s", schema_version)
-        self._raise_for_invalid_version(schema_version)
+        """Migrate in a transaction holding the write lock, so threads and processes migrating
+        the same database at the same time wait for it, and see the migrated version.
+        """
+        connection = self._get_connection()
+        isolation_level = connection.isolation_level
+        connection.isolation_level = None
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                schema_version = self._get_migration_version() if self._has_database() else '0'
+                logger.info("schema_version: %s", schema_version)
+                self._raise_for_invalid_version(schema_version)
 
-        for sql_file in self._iter_diff(schema_version):
-            logger.info("Run migration: %s", sql_file)
-            self._run_migration_sql_file(sql_file)
+                for sql_file in self._iter_diff(schema_version):
+                    logger.info("Run migration: %s", sql_file)
+                    self._run_migration_sql_file(sql_file)
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+        finally:
+            connection.isolation_level = isolation_level
 
     def migrate(self) -> None:
+        if self.connection:
+            self._migrate()
+            return
+
         db.reconnect()
         try:
             self._migrate()
@@ -110,54 +314,174 @@ class Migrator:
 class MessageLog:
     def __init__(
             self, *, id: int=None, queue_name: str, task_name: str, message: str,
-            created_at: datetime.datetime
+            created_at: datetime.datetime, payload: Optional[bytes]=None,
+            serializer: Optional[str]=None
     ) -> None:
+        """
+        :param message: JSON to show. bytes are rendered as Base64.
+        :param payload: The message serialized by serializer. None if message is the original.
+        """
         self.id = id
         self.queue_name = queue_name
         self.task_name = task_name
         self.message = message
         self.created_at = created_at
+        self.payload = payload
+        self.serializer = serializer
+
+    def load_message(self) -> Any:
+        """Return the message as it was received, e.g. to publish it again.
+        """
+        if self.payload is None:
+            return json.loads(self.message)
+        return brokkoly.serializer.loads(self.serializer, self.payload)  # type: ignore
 
     @classmethod
-    def get_by_id(cls, id: int) -> Optional['MessageLog']:
-        with contextlib.closing(db.get().cursor()) as cursor:
+    def get_by_id(cls, queue_name: str, id: int) -> Optional['MessageLog']:
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
             cursor.execute("SELECT * FROM message_logs WHERE message_logs.id = ?", (id, ))
             return cls.from_sqlite3_row(cursor.fetchone())
 
     @classmethod
-    def create(cls, queue_name: str, task_name: str, message: str) -> 'MessageLog':
-        with contextlib.closing(db.get().cursor()) as cursor:
+    def create(
+            cls, queue_name: str, task_name: str, message: str, *,
+            payload: Optional[bytes]=None, serializer: Optional[str]=None
+    ) -> 'MessageLog':
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
             cursor.execute("""
-            INSERT INTO message_logs (queue_name, task_name, message)
-            VALUES (?, ?, ?)
-            ;""", (queue_name, task_name, message, ))
+            INSERT INTO message_logs (queue_name, task_name, message, payload, serializer)
+            VALUES (?, ?, ?, ?, ?)
+            ;""", (queue_name, task_name, message, payload, serializer, ))
             # If SQLite3 supports "returning", I can use it here.
             id = cursor.lastrowid
 
-        return cls.get_by_id(id)
+        return cls.get_by_id(queue_name, id)
 
     @classmethod
     def list_by_queue_name_and_task_name(
-            cls, queue_name: str, task_name: str) -> Iterator['MessageLog']:
-        with contextlib.closing(db.get().cursor()) as cursor:
+            cls, queue_name: str, task_name: str, *, before: Optional[int]=None,
+            limit: int=100
+    ) -> Iterator['MessageLog']:
+        """Return messages from newer one.
+
+        :param before: For pagination. Returning messages have smaller id than this.
+        """
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
             cursor.execute("""
             SELECT *
             FROM message_logs
             WHERE
                 message_logs.queue_name = ? AND
-                message_logs.task_name = ?
-            ORDER BY message_logs.created_at DESC
-            ;""", (queue_name, task_name, ))
+                message_logs.task_name = ? AND
+                message_logs.id < ?
+            ORDER BY message_logs.id DESC
+            LIMIT ?
+            ;""", (queue_name, task_name, _MAX_ID if before is None else before, limit, ))
 
             return (cls.from_sqlite3_row(row) for row in cursor.fetchall())
 
+    @classmethod
+    def search(
+            cls, queue_name: str, task_name: str, text: str, *, before: Optional[int]=None,
+            limit: int=100
+    ) -> Iterator['MessageLog']:
+        """Return messages containing the text from newer one.
+
+        :param before: For pagination. Returning messages have smaller id than this.
+        """
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
+            cursor.execute("""
+            SELECT message_logs.*
+            FROM message_logs_fts
+            JOIN message_logs ON message_logs.id = message_logs_fts.rowid
+            WHERE
+                message_logs_fts MATCH ? AND
+                message_logs.queue_name = ? AND
+                message_logs.task_name = ? AND
+                message_logs.id < ?
+            ORDER BY message_logs.id DESC
+            LIMIT ?
+            ;""", (
+                _fts_phrase(text), queue_name, task_name,
+                _MAX_ID if before is None else before, limit,
+            ))
+
+            return (cls.from_sqlite3_row(row) for row in cursor.fetchall())
+
+    @classmethod
+    def iterate(
+            cls, queue_name: str, task_name: str, *, min_id: Optional[int]=None,
+            max_id: Optional[int]=None, since: Optional[datetime.datetime]=None,
+            until: Optional[datetime.datetime]=None, text: Optional[str]=None,
+            chunk_size: int=1000
+    ) -> Iterator['MessageLog']:
+        """Yield messages from older one.
+
+        It reads chunk by chunk, so it neither holds all messages in memory nor keeps a read
+        transaction open while the caller processes them.
+
+        :param since: Inclusive. UTC.
+        :param until: Exclusive. UTC.
+        :param text: Only messages containing the text.
+        """
+        tables = "message_logs"
+        conditions = [
+            "message_logs.queue_name = :queue_name",
+            "message_logs.task_name = :task_name",
+            "message_logs.id > :last_id",
+        ]
+        params = {
+            'queue_name': queue_name,
+            'task_name': task_name,
+            'last_id': 0 if min_id is None else min_id - 1,
+            'chunk_size': chunk_size,
+        }  # type: Dict[str, Any]
+        if max_id is not None:
+            conditions.append("message_logs.id <= :max_id")
+            params['max_id'] = max_id
+        # created_at is stored by CURRENT_TIMESTAMP.
+        if since is not None:
+            conditions.append("message_logs.created_at >= :since")
+            params['since'] = since.strftime('%Y-%m-%d %H:%M:%S')
+        if until is not None:
+            conditions.append("message_logs.created_at < :until")
+            params['until'] = until.strftime('%Y-%m-%d %H:%M:%S')
+        if text:
+            tables += " JOIN message_logs_fts ON message_logs.id = message_logs_fts.rowid"
+            conditions.append("message_logs_fts MATCH :text")
+            params['text'] = _fts_phrase(text)
+
+        sql = """
+        SELECT message_logs.*
+        FROM {}
+        WHERE {}
+        ORDER BY message_logs.id
+        LIMIT :chunk_size
+        ;""".format(tables, " AND ".join(conditions))
+
+        while True:
+            with contextlib.closing(db.get(queue_name).cursor()) as cursor:
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+
+            for row in rows:
+                yield cls.from_sqlite3_row(row)
+            if len(rows) < chunk_size:
+                return
+            params['last_id'] = rows[-1]['id']
+
     @classmethod
     def from_sqlite3_row(cls, row: Optional[sqlite3.Row]) -> Optional['MessageLog']:
         return cls(**row) if row else None  # type: ignore
 
+    @classmethod
+    def delete(cls, queue_name: str, id: int) -> None:
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
+            cursor.execute("DELETE FROM message_logs WHERE message_logs.id = ?", (id, ))
+
     @classmethod
     def eliminate(cls, queue_name: str, task_name: str) -> None:
-        with contextlib.closing(db.get().cursor()) as cursor:
+        with contextlib.closing(db.get(queue_name).cursor()) as cursor:
             cursor.execute("""
             DELETE FROM message_logs
             WHERE
@@ -177,3 +501,243 @@ class MessageLog:
                 'queue_name': queue_name,
                 'task_name': task_name,
             })
+
+
+class DelayedMessage:
+    def __init__(
+            self, *, id: int=None, queue_name: str, task_name: str, message: bytes,
+            serializer: str, due_at: float
+    ) -> None:
+        self.id = id
+        self.queue_name = queue_name
+        self.task_name = task_name
+        self.message = message
+        self.serializer = serializer
+        self.due_at = due_at
+
+    @classmethod
+    def create(
+            cls, queue_name: str, task_name: str, message: bytes, serializer: str, due_at: float
+    ) -> None:
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            INSERT INTO delayed_messages (queue_name, task_name, message, serializer, due_at)
+            VALUES (?, ?, ?, ?, ?)
+            ;""", (queue_name, task_name, message, serializer, due_at, ))
+
+    @classmethod
+    def list_due_before(
+            cls, due_at: float, *, after: Optional[Tuple[float, int]]=None, limit: int=-1
+    ) -> Iterator['DelayedMessage']:
+        """Return messages from earlier one.
+
+        :param after: For pagination. (due_at, id) of the last message of the previous page.
+        :param limit: No limit if it is negative.
+        """
+        last_due_at, last_id = after or (float('-inf'), 0)
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            SELECT *
+            FROM delayed_messages
+            WHERE
+                delayed_messages.due_at < :due_at AND (
+                    delayed_messages.due_at > :last_due_at OR (
+                        delayed_messages.due_at = :last_due_at AND
+                        delayed_messages.id > :last_id
+                    )
+                )
+            ORDER BY delayed_messages.due_at, delayed_messages.id
+            LIMIT :limit
+            ;""", {
+                'due_at': due_at, 'last_due_at': last_due_at, 'last_id': last_id,
+                'limit': limit,
+            })
+
+            return (cls(**row) for row in cursor.fetchall())
+
+    @classmethod
+    def delete(cls, id: int) -> bool:
+        """Return False if it is already deleted.
+        """
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("DELETE FROM delayed_messages WHERE delayed_messages.id = ?", (id, ))
+            return cursor.rowcount == 1
+
+
+class CoalescedMessage:
+    def __init__(
+            self, *, queue_name: str, task_name: str, key: str, message: bytes, serializer: str,
+            due_at: float
+    ) -> None:
+        self.queue_name = queue_name
+        self.task_name = task_name
+        self.key = key
+        self.message = message
+        self.serializer = serializer
+        self.due_at = due_at
+
+    @classmethod
+    def get(cls, queue_name: str, task_name: str, key: str) -> Optional['CoalescedMessage']:
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            SELECT *
+            FROM coalesced_messages
+            WHERE
+                coalesced_messages.queue_name = ? AND
+                coalesced_messages.task_name = ? AND
+                coalesced_messages.key = ?
+            ;""", (queue_name, task_name, key, ))
+            row = cursor.fetchone()
+            return cls(**row) if row else None
+
+    @classmethod
+    def create(
+            cls, queue_name: str, task_name: str, key: str, message: bytes, serializer: str,
+            due_at: float
+    ) -> bool:
+        """Return False if the key already exists.
+        """
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            INSERT OR IGNORE INTO coalesced_messages (
+                queue_name, task_name, key, message, serializer, due_at
+            )
+            VALUES (?, ?, ?, ?, ?, ?)
+            ;""", (queue_name, task_name, key, message, serializer, due_at, ))
+            return cursor.rowcount == 1
+
+    @classmethod
+    def replace_message(cls, coalesced_message: 'CoalescedMessage', message: bytes) -> bool:
+        """Return False if the message is updated or deleted by others.
+        """
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            UPDATE coalesced_messages
+            SET message = :message
+            WHERE
+                queue_name = :queue_name AND
+                task_name = :task_name AND
+                key = :key AND
+                message = :old_message
+            ;""", {
+                'message': message,
+                'queue_name': coalesced_message.queue_name,
+                'task_name': coalesced_message.task_name,
+                'key': coalesced_message.key,
+                'old_message': coalesced_message.message,
+            })
+            return cursor.rowcount == 1
+
+    @classmethod
+    def list_due_before(cls, due_at: float) -> Iterator['CoalescedMessage']:
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            SELECT *
+            FROM coalesced_messages
+            WHERE coalesced_messages.due_at <= ?
+            ORDER BY coalesced_messages.due_at
+            ;""", (due_at, ))
+
+            return (cls(**row) for row in cursor.fetchall())
+
+    @classmethod
+    def delete(cls, coalesced_message: 'CoalescedMessage') -> bool:
+        """Return False if the message is updated or deleted by others.
+        """
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            DELETE FROM coalesced_messages
+            WHERE
+                queue_name = ? AND
+                task_name = ? AND
+                key = ? AND
+                message = ?
+            ;""", (
+                coalesced_message.queue_name, coalesced_message.task_name, coalesced_message.key,
+                coalesced_message.message,
+            ))
+            return cursor.rowcount == 1
+
+
+class DeadLetter:
+    def __init__(
+            self, *, id: int=None, queue_name: str, task_name: str, message: bytes,
+            serializer: str, error_type: str, error: str, retries: int,
+            created_at: datetime.datetime
+    ) -> None:
+        self.id = id
+        self.queue_name = queue_name
+        self.task_name = task_name
+        self.message = message
+        self.serializer = serializer
+        self.error_type = error_type
+        self.error = error
+        self.retries = retries
+        self.created_at = created_at
+
+    @classmethod
+    def create(
+            cls, queue_name: str, task_name: str, message: bytes, serializer: str,
+            error_type: str, error: str, retries: int, *,
+            connection: Optional[sqlite3.Connection]=None
+    ) -> None:
+        """
+        :param connection: Workers don't have the connection of the thread, so they give one.
+        """
+        with contextlib.closing((connection or db.get()).cursor()) as cursor:  # type: ignore
+            cursor.execute("""
+            INSERT INTO dead_letters (
+                queue_name, task_name, message, serializer, error_type, error, retries
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ;""", (queue_name, task_name, message, serializer, error_type, error, retries, ))
+
+    @classmethod
+    def list_by_queue_name_and_task_name(
+            cls, queue_name: str, task_name: str, *, error_type: Optional[str]=None,
+            ids: Optional[List[int]]=None, before: Optional[int]=None, limit: int=100
+    ) -> Iterator['DeadLetter']:
+        """Return dead letters from newer one. They are filtered by error_type and ids if given.
+        """
+        conditions = ["queue_name = ?", "task_name = ?", "id < ?"]
+        params = [queue_name, task_name, _MAX_ID if before is None else before]  # type: List[Any]
+        if error_type is not None:
+            conditions.append("error_type = ?")
+            params.append(error_type)
+        if ids is not None:
+            conditions.append("id IN ({})".format(", ".join("?" * len(ids))))
+            params.extend(ids)
+
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            SELECT *
+            FROM dead_letters
+            WHERE {}
+            ORDER BY id DESC
+            LIMIT ?
+            ;""".format(" AND ".join(conditions)), params + [limit])
+
+            return (cls(**row) for row in cursor.fetchall())
+
+    @classmethod
+    def count_by_error_type(cls, queue_name: str, task_name: str) -> List[Tuple[str, int]]:
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("""
+            SELECT error_type, COUNT(*)
+            FROM dead_letters
+            WHERE
+                queue_name = ? AND
+                task_name = ?
+            GROUP BY error_type
+            ORDER BY COUNT(*) DESC, error_type
+            ;""", (queue_name, task_name, ))
+
+            return [(error_type, count) for error_type, count in cursor.fetchall()]
+
+    @classmethod
+    def delete(cls, id: int) -> bool:
+        """Return False if it is already deleted.
+        """
+        with contextlib.closing(db.get().cursor()) as cursor:
+            cursor.execute("DELETE FROM dead_letters WHERE dead_letters.id = ?", (id, ))
+            return cursor.rowcount == 1
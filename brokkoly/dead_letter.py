@@ -0,0 +1,126 @@
+"""Messages whose task failed finally.
+
+Workers store the message, the exception and the retry count into a dead letter store. The
+producer lists them and publishes them again.
+"""
+import abc
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+from typing import (  # NOQA
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+import brokkoly
+import brokkoly.database
+import brokkoly.hook
+import brokkoly.ratelimit
+import brokkoly.serializer
+
+
+logger = logging.getLogger(__name__)
+
+
+class DeadLetterStore(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def put(
+            self, queue_name: str, task_name: str, message: bytes, serializer: str,
+            error: Exception, retries: int
+    ) -> None:
+        """
+        :param message: Serialized keyword arguments of the task as it was published.
+        """
+        ...
+
+
+class DatabaseDeadLetterStore(DeadLetterStore):
+    """Store dead letters into the database of the producer.
+
+    Workers write into the database file, so put it on the host of workers or share it, in the
+    same way as the blob store of claim check.
+    """
+
+    def __init__(self, database: str="brokkoly.db") -> None:
+        self.database = database
+        self._lock = threading.Lock()
+        self._migrated = False
+
+    def put(
+            self, queue_name: str, task_name: str, message: bytes, serializer: str,
+            error: Exception, retries: int
+    ) -> None:
+        # Tasks rarely fail finally, so connect to the database for each dead letter.
+        with contextlib.closing(sqlite3.connect(self.database)) as connection:
+            with self._lock:
+                if not self._migrated:
+                    brokkoly.database.Migrator(brokkoly.__version__, connection).migrate()
+                    self._migrated = True
+            brokkoly.database.DeadLetter.create(
+                queue_name, task_name, message, serializer, type(error).__name__, str(error),
+                retries, connection=connection
+            )
+            connection.commit()
+
+
+def put(
+        store: Optional[DeadLetterStore], queue_name: str, task_name: str, serializer: str,
+        kwargs: Dict[str, Any], error: Exception, retries: int
+) -> None:
+    """Store the message if the store is given. An error of the store is only logged, not to hide
+    the error of the task.
+    """
+    if store is None:
+        return
+    try:
+        store.put(
+            queue_name, task_name, brokkoly.serializer.dumps(serializer, kwargs), serializer,
+            error, retries
+        )
+    except Exception:
+        logger.exception("Failed to store dead letter: %s/%s %s", queue_name, task_name, kwargs)
+
+
+def requeue(
+        queue_name: str, task_name: str, *, ids: Optional[List[int]]=None,
+        error_type: Optional[str]=None, rate: Optional[float]=None, limit: int=1000
+) -> int:
+    """Publish dead letters again from newer one, and return the number of them.
+
+    A dead letter is deleted when it is published. The retry count starts from 0 again. A database
+    connection for the current thread is required.
+
+    :param rate: Maximum number of messages per second. If it is None, no limit.
+    """
+    (task, _), _ = brokkoly._validate_queue_and_task(queue_name, task_name)
+    rate_limiter = brokkoly.ratelimit.RateLimiter(rate) if rate else None
+    connection = brokkoly.database.db.get()
+    requeued = 0
+    dead_letters = brokkoly.database.DeadLetter.list_by_queue_name_and_task_name(
+        queue_name, task_name, error_type=error_type, ids=ids, limit=limit)
+    for dead_letter in dead_letters:
+        # Wait before deleting it, not to hold the write transaction while waiting.
+        if rate_limiter:
+            rate_limiter.acquire()
+        # Other requests may requeue it already.
+        if not brokkoly.database.DeadLetter.delete(dead_letter.id):  # type: ignore
+            connection.rollback()  # type: ignore
+            continue
+        try:
+            # Messages are published as they were, claim check references are kept.
+            task.apply_async(
+                kwargs=brokkoly.serializer.loads(dead_letter.serializer, dead_letter.message),
+                serializer=dead_letter.serializer, compression='zlib',
+                headers={brokkoly.hook.PUBLISHED_AT_HEADER: time.time()}
+            )
+        except Exception:
+            logger.exception("Failed to requeue dead letter: %s", dead_letter.id)
+            connection.rollback()  # type: ignore
+            continue
+        connection.commit()  # type: ignore
+        requeued += 1
+    return requeued
@@ -0,0 +1,199 @@
+import abc
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import random
+import time
+from typing import (  # NOQA
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+)
+
+import celery.utils.time
+
+
+logger = logging.getLogger(__name__)
+
+
+# Message header which the producer sets with time.time() when it publishes.
+PUBLISHED_AT_HEADER = 'brokkoly_published_at'
+
+# published_at: When the message is published. None if the message doesn't have the header.
+# eta: When the message is scheduled by countdown or eta. None if it isn't scheduled.
+# retries: How many times the message has been retried.
+# size: The number of messages. It is more than 1 only for batched tasks.
+# coroutine: True if the task is a coroutine function. It runs on the event loop with others.
+Invocation = collections.namedtuple(
+    'Invocation',
+    ['queue_name', 'task_name', 'published_at', 'eta', 'retries', 'size', 'coroutine']
+)
+
+
+class Hook(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def around(self, invocation: Invocation) -> Any:
+        """Return a context manager which wraps calling the task.
+
+        An exception raised by the task is propagated through the context manager.
+        """
+        ...
+
+
+class TaskStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.failures = 0
+        # The number of invocations which are retries.
+        self.retried = 0
+        self.elapsed = 0.0
+        self.max_elapsed = 0.0
+        self.wait = 0.0
+
+
+class TimingHook(Hook):
+    """Log execution time, queue wait time and retry count, and aggregate them per task.
+
+    Queue wait time is from when the message can run, i.e. when it is published or its eta, to
+    when the task is called. Each retry is published again, so the wait is of the last attempt.
+    """
+
+    def __init__(self, log_level: int=logging.INFO) -> None:
+        self.log_level = log_level
+        self.stats = collections.defaultdict(TaskStats)  # type: Dict[str, TaskStats]
+
+    @contextlib.contextmanager
+    def around(self, invocation: Invocation) -> Iterator[None]:
+        started_at = time.time()
+        wait = started_at - max(invocation.published_at, invocation.eta or 0.0) \
+            if invocation.published_at else None
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.time() - started_at
+            stats = self.stats[invocation.task_name]
+            stats.count += invocation.size
+            stats.failures += invocation.size if failed else 0
+            stats.retried += 1 if invocation.retries else 0
+            stats.elapsed += elapsed
+            stats.max_elapsed = max(stats.max_elapsed, elapsed)
+            stats.wait += wait or 0.0
+            logger.log(
+                self.log_level, "%s/%s elapsed: %.6f wait: %s retries: %d size: %d failed: %s",
+                invocation.queue_name, invocation.task_name, elapsed,
+                "unknown" if wait is None else "{:.6f}".format(wait), invocation.retries,
+                invocation.size, failed
+            )
+
+
+class ProfileHook(Hook):
+    """Profile a fraction of invocations with cProfile.
+
+    Profiles are aggregated per task and written into the directory as
+    {queue_name}.{task_name}.{pid}.prof. Read them with pstats or snakeviz.
+
+    Coroutine tasks are not profiled. cProfile profiles a thread, and coroutines running at the
+    same time on the event loop would be mixed into the profile.
+    """
+
+    def __init__(self, directory: str, *, rate: float=0.01, dump_every: int=100) -> None:
+        """
+        :param rate: Fraction of invocations to profile.
+        :param dump_every: Write the aggregated profile every this number of samples.
+        """
+        self.directory = directory
+        self.rate = rate
+        self.dump_every = dump_every
+        self._stats = {}  # type: Dict[str, pstats.Stats]
+        self._samples = collections.Counter()  # type: collections.Counter
+
+    def _dump(self, invocation: Invocation) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        filename = "{}.{}.{}.prof".format(
+            invocation.queue_name, invocation.task_name, os.getpid())
+        self._stats[invocation.task_name].dump_stats(os.path.join(self.directory, filename))
+
+    @contextlib.contextmanager
+    def around(self, invocation: Invocation) -> Iterator[None]:
+        if invocation.coroutine or random.random() >= self.rate:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if invocation.task_name in self._stats:
+                self._stats[invocation.task_name].add(profile)
+            else:
+                self._stats[invocation.task_name] = pstats.Stats(profile)
+            self._samples[invocation.task_name] += 1
+            if not self._samples[invocation.task_name] % self.dump_every:
+                self._dump(invocation)
+
+
+def _published_at(request: Any) -> Optional[float]:
+    # Celery exposes custom headers as attributes of the request, or in its headers.
+    value = getattr(request, PUBLISHED_AT_HEADER, None)
+    if value is None:
+        value = (getattr(request, 'headers', None) or {}).get(PUBLISHED_AT_HEADER)
+    return value if isinstance(value, (int, float)) else None
+
+
+def _eta(value: Any) -> Optional[float]:
+    # Celery gives eta as ISO 8601 string or datetime.
+    if not value:
+        return None
+    try:
+        return celery.utils.time.maybe_iso8601(value).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def run(hooks: Iterable[Hook], invocation: Invocation) -> Iterator[None]:
+    with contextlib.ExitStack() as stack:
+        for hook in hooks:
+            stack.enter_context(hook.around(invocation))
+        yield
+
+
+def invocation_of(
+        queue_name: str, task_name: str, request: Any, coroutine: bool=False) -> Invocation:
+    """Return Invocation for the request of a Celery task.
+    """
+    return Invocation(
+        queue_name, task_name, _published_at(request), _eta(getattr(request, 'eta', None)),
+        request.retries or 0, 1, coroutine
+    )
+
+
+def invocation_of_batch(queue_name: str, task_name: str, requests: Any) -> Invocation:
+    """Return Invocation for buffered requests. It has published_at and eta of the message
+    which could run first.
+    """
+    request_dicts = [request.request_dict or {} for request in requests]
+    times = [
+        (published_at, _eta(request_dict.get('eta'))) for published_at, request_dict in (
+            (request_dict.get(PUBLISHED_AT_HEADER), request_dict)
+            for request_dict in request_dicts
+        ) if isinstance(published_at, (int, float))
+    ]
+    published_at, eta = min(
+        times, key=lambda pair: max(pair[0], pair[1] or 0.0), default=(None, None))
+    return Invocation(
+        queue_name, task_name, published_at, eta,
+        max((request_dict.get('retries') or 0 for request_dict in request_dicts), default=0),
+        len(request_dicts), False
+    )
@@ -0,0 +1,123 @@
+"""Priority lanes of tasks.
+
+Messages of each priority go to their own Celery queue, a lane. Workers consume lanes in the
+ratio of their weights with smooth weighted round robin, so lower priorities are not starved. When
+a lane is empty, the next one is consumed.
+
+The ratio is applied by kombu transports having queue_order_strategy, e.g. Redis. Other brokers
+consume lanes in round robin.
+"""
+from typing import (  # NOQA
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+)
+
+import kombu
+
+import brokkoly
+
+
+QUEUE_ORDER_STRATEGY = 'brokkoly.priority:WeightedCycle'
+
+# Celery queue name -> weight. Queues which are not lanes have weight 1.
+_weights = {}  # type: Dict[str, int]
+
+
+class Priority:
+    def __init__(
+            self, weights: Sequence[int]=(1, 4, 16), *, default: int=0,
+            maximum: Optional[int]=None
+    ) -> None:
+        """
+        :param weights: Weights of priorities from 0. The larger priority is the higher.
+        :param default: Priority of messages which don't have it.
+        :param maximum: Clients can't give higher priority than this. e.g. to keep a task for
+        backfill in lower lanes. The highest priority by default.
+        """
+        if not weights or any(weight < 1 for weight in weights):
+            raise brokkoly.BrokkolyError("weights must be positive.")
+        self.weights = list(weights)
+        self.maximum = len(self.weights) - 1 if maximum is None else maximum
+        if not 0 <= self.maximum < len(self.weights):
+            raise brokkoly.BrokkolyError("maximum must be one of priorities.")
+        if not 0 <= default <= self.maximum:
+            raise brokkoly.BrokkolyError("default must be up to maximum.")
+        self.default = default
+
+    def check(self, priority: Any) -> int:
+        """Return the priority of a message. Raise ValueError for invalid one.
+        """
+        if priority is None:
+            return self.default
+        # bool is int.
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError("priority must be int")
+        if not 0 <= priority <= self.maximum:
+            raise ValueError("priority must be from 0 to {}".format(self.maximum))
+        return priority
+
+
+def lane(queue_name: str, task_name: str, priority: int) -> str:
+    """Return the Celery queue name of the lane.
+    """
+    return "{}.{}.priority.{}".format(queue_name, task_name, priority)
+
+
+def lane_of(request: Any) -> Optional[str]:
+    """Return the Celery queue which the request came from.
+    """
+    return (getattr(request, 'delivery_info', None) or {}).get('routing_key')
+
+
+def register(app: Any, queue_name: str, task_name: str, priority: Priority) -> None:
+    """Make workers of the Celery app consume lanes of the task with their weights.
+    """
+    queues = list(app.conf.task_queues or [kombu.Queue(app.conf.task_default_queue)])
+    for i, weight in enumerate(priority.weights):
+        name = lane(queue_name, task_name, i)
+        _weights[name] = weight
+        queues.append(kombu.Queue(name))
+    app.conf.task_queues = queues
+    app.conf.broker_transport_options = dict(
+        app.conf.broker_transport_options or {}, queue_order_strategy=QUEUE_ORDER_STRATEGY)
+
+
+class WeightedCycle:
+    """Order of queues which kombu consumes, by smooth weighted round robin.
+
+    kombu calls consume to get the order, and rotate with the queue which a message came from.
+    The broker returns a message from the first queue having one, so queues before it in the
+    order were empty. Empty queues don't earn credit, and their credit is reset, so a queue which
+    was idle doesn't take over others when messages come to it.
+    """
+
+    def __init__(self, it: Optional[List[str]]=None) -> None:
+        self.items = it if it is not None else []
+        self._current = {}  # type: Dict[str, int]
+        # The last order returned by consume.
+        self._order = []  # type: List[str]
+
+    def update(self, it: Sequence[str]) -> None:
+        self.items[:] = it
+
+    def consume(self, n: int) -> List[str]:
+        items = self.items[:n]
+        self._order = sorted(items, key=lambda item: -self._current.get(item, 0))
+        return self._order
+
+    def rotate(self, last_used: str) -> str:
+        empty = set(
+            self._order[:self._order.index(last_used)] if last_used in self._order else [])
+        total = 0
+        for item in self.items:
+            if item in empty:
+                self._current[item] = 0
+                continue
+            weight = _weights.get(item, 1)
+            self._current[item] = self._current.get(item, 0) + weight
+            total += weight
+        self._current[last_used] = self._current.get(last_used, 0) - total
+        return last_used
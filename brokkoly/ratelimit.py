@@ -0,0 +1,18 @@
+import time
+
+
+class RateLimiter:
+    def __init__(self, rate: float) -> None:
+        """
+        :param rate: Maximum number of calls per second.
+        """
+        self._interval = 1 / rate
+        self._next_at = time.monotonic()
+
+    def acquire(self) -> None:
+        """Block until the next call is allowed.
+        """
+        now = time.monotonic()
+        if self._next_at > now:
+            time.sleep(self._next_at - now)
+        self._next_at = max(self._next_at, now) + self._interval
@@ -0,0 +1,144 @@
+"""Publish logged messages again.
+
+Usage: python -m brokkoly.replay --tasks tasks example echo --since "2017-07-04 00:00:00"
+"""
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import importlib
+import logging
+import sys
+from typing import (  # NOQA
+    Callable,
+    Optional,
+    Set,
+)
+
+import falcon
+
+import brokkoly
+import brokkoly.database
+import brokkoly.ratelimit
+
+
+logger = logging.getLogger(__name__)
+
+
+Progress = collections.namedtuple('Progress', ['published', 'failed'])
+
+
+def replay(
+        queue_name: str, task_name: str, *, min_id: Optional[int]=None,
+        max_id: Optional[int]=None, since: Optional[datetime.datetime]=None,
+        until: Optional[datetime.datetime]=None, text: Optional[str]=None,
+        rate: Optional[float]=None, concurrency: int=1,
+        progress: Optional[Callable[[Progress], None]]=None, progress_every: int=1000
+) -> Progress:
+    """Publish logged messages again from older one.
+
+    Messages are validated with preprocessors of the current task. Invalid messages are skipped
+    and counted as failed. A database connection for the current thread is required.
+
+    :param rate: Maximum number of messages per second. If it is None, no limit.
+    :param concurrency: Number of threads publishing messages.
+    :param progress: It is called with the progress every progress_every messages and at the end.
+    """
+    try:
+        (_, validation), preprocessors = brokkoly._validate_queue_and_task(queue_name, task_name)
+    except falcon.HTTPBadRequest as e:
+        raise brokkoly.BrokkolyError(e.description) from e
+
+    rate_limiter = brokkoly.ratelimit.RateLimiter(rate) if rate else None
+    published = failed = 0
+
+    def count(future: concurrent.futures.Future) -> None:
+        nonlocal published, failed
+        if future.exception():
+            logger.error("Failed to publish", exc_info=future.exception())
+            failed += 1
+        else:
+            published += 1
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = set()  # type: Set[concurrent.futures.Future]
+        message_logs = brokkoly.database.MessageLog.iterate(
+            queue_name, task_name, min_id=min_id, max_id=max_id, since=since, until=until,
+            text=text
+        )
+        for i, message_log in enumerate(message_logs, 1):
+            try:
+                kwargs = brokkoly._prepare_kwargs(
+                    message_log.load_message(), validation, preprocessors)
+            except falcon.HTTPBadRequest as e:
+                logger.warning("Skip invalid message %s: %s", message_log.id, e.description)
+                failed += 1
+            else:
+                # Don't read messages faster than publishing.
+                if len(in_flight) >= concurrency:
+                    done, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        count(future)
+                if rate_limiter:
+                    rate_limiter.acquire()
+                in_flight.add(executor.submit(brokkoly._publish, queue_name, task_name, kwargs))
+
+            if progress and not i % progress_every:
+                progress(Progress(published, failed))
+
+        for future in concurrent.futures.as_completed(in_flight):
+            count(future)
+
+    result = Progress(published, failed)
+    if progress:
+        progress(result)
+    return result
+
+
+def _parse_datetime(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Publish logged messages again.")
+    parser.add_argument('queue_name')
+    parser.add_argument('task_name')
+    parser.add_argument(
+        '--tasks', required=True, help="Module registering tasks, the same one as the producer.")
+    parser.add_argument('--db', default="brokkoly.db")
+    parser.add_argument(
+        '--shard-message-logs', action='store_true',
+        help="Read message logs from the database file of the queue.")
+    parser.add_argument('--min-id', type=int)
+    parser.add_argument('--max-id', type=int)
+    parser.add_argument('--since', type=_parse_datetime, help="UTC, YYYY-MM-DD HH:MM:SS")
+    parser.add_argument('--until', type=_parse_datetime, help="UTC, YYYY-MM-DD HH:MM:SS")
+    parser.add_argument('--search', help="Only messages containing the text.")
+    parser.add_argument('--rate', type=float, help="Maximum number of messages per second.")
+    parser.add_argument('--concurrency', type=int, default=1)
+    args = parser.parse_args()
+
+    brokkoly.init_logger(logging.INFO)
+    importlib.import_module(args.tasks)
+    brokkoly.database.db.dbname = args.db
+    brokkoly.database.db.shard_message_logs = args.shard_message_logs
+    brokkoly.database.db.reconnect()
+
+    def report(progress: Progress) -> None:
+        print("published: {}, failed: {}".format(*progress), file=sys.stderr)
+
+    try:
+        result = replay(
+            args.queue_name, args.task_name, min_id=args.min_id, max_id=args.max_id,
+            since=args.since, until=args.until, text=args.search, rate=args.rate,
+            concurrency=args.concurrency, progress=report
+        )
+    finally:
+        brokkoly.database.db.close()
+
+    sys.exit(1 if result.failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,38 @@
 $(function() {
+    var errorArea = $("#error");
+    errorArea.hide();
+
+    $(".requeue").on("click", function() {
+        var button = $(this);
+        var payload = {};
+        if (button.data("id")) {
+            payload.ids = [button.data("id")];
+        } else if (button.data("error-type")) {
+            payload.error_type = String(button.data("error-type"));
+        }
+        $.ajax({
+            type: "POST",
+            url: window.location.pathname + "/requeue",
+            data: JSON.stringify(payload),
+            contentType: "application/json",
+            dataType: "json"
+        }).done(function(response) {
+            window.location.reload();
+        }).fail(function(response) {
+            errorArea.text(response["responseJSON"]["description"]);
+            errorArea.show();
+        });
+    });
+
+    if (!$("#editor").length) {
+        return;
+    }
     var editor = ace.edit("editor");
     editor.session.setMode("ace/mode/json");
     editor.setTheme("ace/theme/monokai");
     editor.setOptions({
         fontSize: "15pt"
     });
-    var errorArea = $("#error");
-    errorArea.hide();
 
     $("#submit").on("click", function() {
         $.ajax({
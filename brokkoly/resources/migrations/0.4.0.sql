@@ -0,0 +1,71 @@
+BEGIN;
+
+INSERT INTO migrations (version) VALUES ('0.4.0');
+
+CREATE TABLE delayed_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue_name TEXT NOT NULL,
+    task_name TEXT NOT NULL,
+    message BLOB NOT NULL,
+    serializer TEXT NOT NULL,
+    due_at REAL NOT NULL
+);
+
+CREATE INDEX delayed_messages_due_at ON delayed_messages(due_at);
+
+CREATE INDEX message_logs_queue_name_task_name_id
+ON message_logs(queue_name, task_name, id);
+
+-- message is JSON for the UI and search. Messages which JSON can't represent, e.g. bytes of
+-- MessagePack, also have the original payload and its serializer.
+ALTER TABLE message_logs ADD COLUMN payload BLOB;
+ALTER TABLE message_logs ADD COLUMN serializer TEXT;
+
+CREATE VIRTUAL TABLE message_logs_fts USING fts5(
+    message,
+    content='message_logs',
+    content_rowid='id'
+);
+
+INSERT INTO message_logs_fts (rowid, message) SELECT id, message FROM message_logs;
+
+CREATE TRIGGER message_logs_fts_insert AFTER INSERT ON message_logs BEGIN
+    INSERT INTO message_logs_fts (rowid, message) VALUES (new.id, new.message);
+END;
+
+CREATE TRIGGER message_logs_fts_delete AFTER DELETE ON message_logs BEGIN
+    INSERT INTO message_logs_fts (message_logs_fts, rowid, message)
+    VALUES ('delete', old.id, old.message);
+END;
+
+CREATE TABLE coalesced_messages (
+    queue_name TEXT NOT NULL,
+    task_name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    message BLOB NOT NULL,
+    serializer TEXT NOT NULL,
+    due_at REAL NOT NULL,
+    PRIMARY KEY (queue_name, task_name, key)
+);
+
+CREATE INDEX coalesced_messages_due_at ON coalesced_messages(due_at);
+
+CREATE TABLE dead_letters (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    queue_name TEXT NOT NULL,
+    task_name TEXT NOT NULL,
+    message BLOB NOT NULL,
+    serializer TEXT NOT NULL,
+    error_type TEXT NOT NULL,
+    error TEXT NOT NULL,
+    retries INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX dead_letters_queue_name_task_name_error_type_id
+ON dead_letters(queue_name, task_name, error_type, id);
+
+CREATE INDEX dead_letters_queue_name_task_name_id
+ON dead_letters(queue_name, task_name, id);
+
+COMMIT;
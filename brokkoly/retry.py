@@ -4,6 +4,8 @@ from typing import Optional
 
 
 RetryMethod = enum.Enum('RetryMethod', ['countdown'])  # type: ignore
+# For batched tasks: retry only the messages which failed, or the whole batch together.
+RetryUnit = enum.Enum('RetryUnit', ['message', 'batch'])  # type: ignore
 
 
 class RetryPolicy(metaclass=abc.ABCMeta):
@@ -21,6 +23,12 @@ class RetryPolicy(metaclass=abc.ABCMeta):
     def countdown(self, retry_count: int, error: Exception) -> int:
         ...
 
+    @property  # type: ignore
+    def retry_unit(self) -> RetryUnit:
+        """It is used only by batched tasks.
+        """
+        return RetryUnit.message  # type: ignore
+
 
 class CountdownPolicy(RetryPolicy):
     ...
@@ -30,8 +38,11 @@ class FibonacciWait(CountdownPolicy):
     """Wait for 1 second, 2 seconds, 3 seconds, 5 seconds ...
     """
 
-    def __init__(self, max_retries: int) -> None:
+    def __init__(
+            self, max_retries: int, *, retry_unit: RetryUnit=RetryUnit.message  # type: ignore
+    ) -> None:
         self._max_retries = max_retries
+        self._retry_unit = retry_unit
 
     @property
     def max_retries(self) -> Optional[int]:
@@ -41,6 +52,10 @@ class FibonacciWait(CountdownPolicy):
     def retry_method(self) -> RetryMethod:
         return RetryMethod.countdown  # type: ignore
 
+    @property  # type: ignore
+    def retry_unit(self) -> RetryUnit:
+        return self._retry_unit
+
     def countdown(self, retry_count: int, error: Exception) -> int:
         x, y = 1, 1
         for _ in range(retry_count):
@@ -0,0 +1,154 @@
+"""Which messages are written into message logs.
+
+Rejected requests and messages failed to be published are not message logs. They are written
+into the logger regardless of these policies.
+"""
+import abc
+import itertools
+import random
+import threading
+import time
+from typing import (  # NOQA
+    Any,
+    Dict,
+    Optional,
+)
+
+import brokkoly.database
+import brokkoly.serializer
+
+
+class Sampling(metaclass=abc.ABCMeta):
+    @abc.abstractmethod
+    def sample(self) -> bool:
+        """Return True if the message should be logged.
+        """
+        ...
+
+    def log(
+            self, queue_name: str, task_name: str, message: Any,
+            serializer: str=brokkoly.serializer.JSON
+    ) -> None:
+        """
+        :param serializer: Serializer of the task. Messages of other than JSON are logged with
+        their payload, because JSON of the message loses bytes.
+        """
+        if self.sample():
+            _create(queue_name, task_name, message, serializer)
+            brokkoly.database.MessageLog.eliminate(queue_name, task_name)
+
+
+def _create(
+        queue_name: str, task_name: str, message: Any, serializer: str
+) -> brokkoly.database.MessageLog:
+    if serializer == brokkoly.serializer.JSON:
+        return brokkoly.database.MessageLog.create(
+            queue_name, task_name, brokkoly.serializer.to_json(message))
+    return brokkoly.database.MessageLog.create(
+        queue_name, task_name, brokkoly.serializer.to_json(message),
+        payload=brokkoly.serializer.dumps(serializer, message), serializer=serializer
+    )
+
+
+class Always(Sampling):
+    def sample(self) -> bool:
+        return True
+
+
+class Never(Sampling):
+    def sample(self) -> bool:
+        return False
+
+
+class OneInN(Sampling):
+    """Log the first message and every n-th message after it.
+    """
+
+    def __init__(self, n: int) -> None:
+        if n < 1:
+            raise brokkoly.BrokkolyError("n must be positive.")
+        self.n = n
+        self._counter = itertools.count()
+
+    def sample(self) -> bool:
+        # next of itertools.count is atomic, so no lock is required.
+        return not next(self._counter) % self.n
+
+
+class RateLimit(Sampling):
+    """Log at most rate messages per second.
+    """
+
+    def __init__(self, rate: float) -> None:
+        if rate <= 0:
+            raise brokkoly.BrokkolyError("rate must be positive.")
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._updated_at = time.monotonic()
+
+    def sample(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                max(self.rate, 1.0), self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class Reservoir(Sampling):
+    """Keep size messages uniformly sampled from each window (seconds).
+
+    The i-th message in a window replaces a random logged one with probability size / i, so
+    writes become rare as the window fills. Each producer process has its own reservoir.
+    """
+
+    def __init__(self, size: int, window: float=60) -> None:
+        if size < 1:
+            raise brokkoly.BrokkolyError("size must be positive.")
+        self.size = size
+        self.window = window
+        self._lock = threading.Lock()
+        self._window_end = 0.0
+        self._seen = 0
+        # Index in the reservoir -> id of the message log
+        self._ids = {}  # type: Dict[int, int]
+
+    def sample(self) -> bool:
+        return self._slot() is not None
+
+    def _slot(self) -> Optional[int]:
+        """Return the index in the reservoir for the next message, or None to skip it.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now >= self._window_end:
+                # Logs of the previous window stay until eliminated.
+                self._window_end = now + self.window
+                self._seen = 0
+                self._ids = {}
+            self._seen += 1
+            if self._seen <= self.size:
+                return self._seen - 1
+            index = random.randrange(self._seen)
+            return index if index < self.size else None
+
+    def log(
+            self, queue_name: str, task_name: str, message: Any,
+            serializer: str=brokkoly.serializer.JSON
+    ) -> None:
+        slot = self._slot()
+        if slot is None:
+            return
+
+        message_log = _create(queue_name, task_name, message, serializer)
+        with self._lock:
+            replaced = self._ids.get(slot)
+            self._ids[slot] = message_log.id  # type: ignore
+        if replaced is None:
+            brokkoly.database.MessageLog.eliminate(queue_name, task_name)
+        else:
+            brokkoly.database.MessageLog.delete(queue_name, replaced)
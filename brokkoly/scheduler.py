@@ -0,0 +1,221 @@
+import collections
+import contextlib
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import (  # NOQA
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+)
+
+import brokkoly.database
+import brokkoly.serializer
+
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Hierarchical timer wheel.
+
+    Level 0 has one slot per tick, level 1 has one slot per `slots` ticks and so on. Items on a
+    higher level are moved to lower levels when the wheel reaches their slot.
+    """
+
+    def __init__(
+            self, start: float, *, resolution: float=1.0, slots: int=64, levels: int=3
+    ) -> None:
+        self.resolution = resolution
+        self._slots = slots
+        self._levels = [
+            [[] for _ in range(slots)] for _ in range(levels)
+        ]  # type: List[List[List]]
+        self._current = math.floor(start / resolution)
+
+    @property
+    def capacity(self) -> float:
+        """Seconds from now which the wheel can hold.
+        """
+        return self._slots ** len(self._levels) * self.resolution
+
+    def _place(self, tick: int, item: Any) -> None:
+        delta = tick - self._current
+        for level, wheel in enumerate(self._levels):
+            if delta < self._slots ** (level + 1):
+                wheel[(tick // self._slots ** level) % self._slots].append((tick, item))
+                return
+        raise ValueError("{} ticks is over the capacity of the wheel".format(delta))
+
+    def add(self, due: float, item: Any) -> None:
+        # Overdue items are fired at next advance.
+        self._place(max(math.ceil(due / self.resolution), self._current), item)
+
+    def _cascade(self) -> None:
+        for level in reversed(range(1, len(self._levels))):
+            span = self._slots ** level
+            if self._current % span:
+                continue
+            slot = self._levels[level][(self._current // span) % self._slots]
+            entries, slot[:] = slot[:], []
+            for tick, item in entries:
+                self._place(tick, item)
+
+    def advance(self, now: float) -> List[Any]:
+        """Return items which are due until now.
+        """
+        expired = []  # type: List[Any]
+        target = math.floor(now / self.resolution)
+        while self._current <= target:
+            self._cascade()
+            slot = self._levels[0][self._current % self._slots]
+            expired.extend(item for _, item in slot)
+            slot[:] = []
+            self._current += 1
+        return expired
+
+
+class DelayScheduler:
+    """Keep delayed messages in SQLite and publish them when they are due.
+
+    Celery workers prefetch ETA tasks into memory, so long delays are held by the producer
+    instead. Only messages due within `horizon` seconds are loaded into the timer wheel, and at
+    most `max_loaded` of them. Messages which are overdue, for example after restarting, are
+    loaded chunk by chunk and published `max_publish` per tick, so the catch-up doesn't hold all
+    of them in memory.
+    """
+
+    def __init__(
+            self, threshold: int, publish: Callable[[str, str, Dict[str, Any]], None], *,
+            horizon: int=300, interval: int=10, resolution: float=1.0, max_loaded: int=10000,
+            max_publish: int=1000, chunk_size: int=1000
+    ) -> None:
+        """
+        :param threshold: Messages having longer delay (seconds) than this are held.
+        :param publish: It is called with queue name, task name and kwargs when a message is due.
+        :param interval: Seconds to wait for next loading from database.
+        :param max_loaded: Maximum number of messages held in memory.
+        :param max_publish: Maximum number of messages published per tick.
+        :param chunk_size: Number of messages read from database at once.
+        """
+        if threshold < interval:
+            # Otherwise a message can be loaded after its due time.
+            raise brokkoly.BrokkolyError("threshold must not be shorter than interval.")
+
+        self.threshold = threshold
+        self._publish = publish
+        self._horizon = horizon
+        self._interval = interval
+        self._resolution = resolution
+        self._max_loaded = max_loaded
+        self._max_publish = max_publish
+        self._chunk_size = chunk_size
+        self._wheel = None  # type: Optional[TimerWheel]
+        # Ids of messages in the wheel or in _due.
+        self._loaded = set()  # type: Set[int]
+        self._loaded_at = 0.0
+        # The last loading stopped at max_loaded.
+        self._truncated = False
+        # Messages which are due but not published yet because of max_publish.
+        self._due = collections.deque()  # type: Deque[Any]
+
+    def schedule(
+            self, queue_name: str, task_name: str, kwargs: Dict[str, Any], delay: int, *,
+            serializer: str=brokkoly.serializer.JSON
+    ) -> None:
+        """
+        :param serializer: Serializer of the task. Messages are stored with it.
+        """
+        brokkoly.database.DelayedMessage.create(
+            queue_name, task_name, brokkoly.serializer.dumps(serializer, kwargs), serializer,
+            time.time() + delay
+        )
+
+    def _load(self, now: float) -> None:
+        self._loaded_at = now
+        self._truncated = False
+        after = None
+        while True:
+            delayed_messages = list(brokkoly.database.DelayedMessage.list_due_before(
+                now + self._horizon, after=after, limit=self._chunk_size))
+            for delayed_message in delayed_messages:
+                if delayed_message.id in self._loaded:
+                    continue
+                if len(self._loaded) >= self._max_loaded:
+                    self._truncated = True
+                    return
+                self._loaded.add(delayed_message.id)
+                self._wheel.add(delayed_message.due_at, (  # type: ignore
+                    delayed_message.id, delayed_message.queue_name, delayed_message.task_name,
+                    brokkoly.serializer.loads(delayed_message.serializer, delayed_message.message)
+                ))
+            if len(delayed_messages) < self._chunk_size:
+                return
+            after = (delayed_messages[-1].due_at, delayed_messages[-1].id)
+
+    def run_pending(self, now: float) -> None:
+        """Publish due messages. This is called by the scheduler thread.
+        """
+        if self._wheel is None:
+            self._wheel = TimerWheel(now, resolution=self._resolution)
+            if self._horizon >= self._wheel.capacity:
+                raise brokkoly.BrokkolyError("horizon is over the capacity of the timer wheel.")
+        # Load the rest of the catch-up as soon as a half of loaded messages are published.
+        if now - self._loaded_at >= self._interval or (
+                self._truncated and len(self._loaded) <= self._max_loaded // 2):
+            self._load(now)
+
+        # All due messages are removed from the wheel, so an error of one message must not stop
+        # the others. A message which is not deleted is loaded again.
+        self._due.extend(self._wheel.advance(now))
+        for _ in range(min(self._max_publish, len(self._due))):
+            id, queue_name, task_name, kwargs = self._due.popleft()
+            self._loaded.discard(id)
+            try:
+                self._publish_due(id, queue_name, task_name, kwargs)
+            except Exception:
+                logger.exception("Failed to publish delayed message: %s", id)
+                try:
+                    brokkoly.database.db.get().rollback()  # type: ignore
+                except sqlite3.Error:
+                    logger.exception("Failed to rollback.")
+
+    def _publish_due(
+            self, id: int, queue_name: str, task_name: str, kwargs: Dict[str, Any]) -> None:
+        # Other producer processes may publish it already.
+        if not brokkoly.database.DelayedMessage.delete(id):
+            brokkoly.database.db.get().rollback()  # type: ignore
+            return
+        self._publish(queue_name, task_name, kwargs)
+        brokkoly.database.db.get().commit()  # type: ignore
+
+    def _reset(self) -> None:
+        self._wheel = None
+        self._loaded = set()
+        self._loaded_at = 0.0
+        self._truncated = False
+        self._due.clear()
+
+    def _run(self) -> None:
+        while True:
+            brokkoly.database.db.reconnect()
+            with contextlib.closing(brokkoly.database.db.get()):  # type: ignore
+                try:
+                    while True:
+                        self.run_pending(time.time())
+                        time.sleep(self._resolution)
+                except Exception:
+                    logger.exception("Delay scheduler is stopped by error. Restart it.")
+            # Load messages again. Some of them may be removed from the wheel but not published.
+            self._reset()
+            time.sleep(self._interval)
+
+    def start(self) -> None:
+        thread = threading.Thread(target=self._run, name="brokkoly-delay-scheduler", daemon=True)
+        thread.start()
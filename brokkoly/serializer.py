@@ -0,0 +1,69 @@
+import base64
+import json
+from typing import Any
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+import brokkoly
+
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Content-Type of request body to serializer.
+CONTENT_TYPES = {
+    'application/json': JSON,
+    'application/msgpack': MSGPACK,
+    'application/x-msgpack': MSGPACK,
+}
+
+
+def check(serializer: str) -> None:
+    if serializer not in (JSON, MSGPACK):
+        raise brokkoly.BrokkolyError("Unsupported serializer: {}".format(serializer))
+    if serializer == MSGPACK and msgpack is None:
+        raise brokkoly.BrokkolyError(
+            "msgpack is required for msgpack serializer. Install brokkoly[msgpack].")
+
+
+def serializer_for(content_type: Any) -> str:
+    """Return serializer for the Content-Type. JSON is the default.
+    """
+    if not isinstance(content_type, str):
+        return JSON
+    return CONTENT_TYPES.get(content_type.split(';')[0].strip().lower(), JSON)
+
+
+def dumps(serializer: str, value: Any) -> bytes:
+    if serializer == MSGPACK:
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value).encode()
+
+
+def loads(serializer: str, body: Any) -> Any:
+    """Raise ValueError for invalid body.
+
+    :param body: bytes-like object. MessagePack is decoded without copying it.
+    """
+    if serializer == MSGPACK:
+        check(MSGPACK)
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as e:
+            raise ValueError("Invalid MessagePack") from e
+    return json.loads(bytes(body).decode())
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def to_json(message: Any) -> str:
+    """Render a message for logs. bytes in MessagePack is shown as Base64.
+    """
+    return json.dumps(message, default=_json_default)
@@ -34,8 +34,10 @@ if sys.version_info < (3, 5):
 
 test_requires = [
     'Pygments',
+    'celery-batches',
     'docutils',
     'flake8',
+    'msgpack',
     'mypy',
     'pytest',
     'pytest-cov',
@@ -51,7 +53,6 @@ setuptools.setup(
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
         "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3 :: Only",
@@ -66,6 +67,8 @@ setuptools.setup(
     install_requires=install_requires,
     extras_require={
         'test': test_requires,
+        'batch': ['celery-batches'],
+        'msgpack': ['msgpack'],
     },
     include_package_data=True,
 )
@@ -1,16 +1,34 @@
+import asyncio
+import collections
+import contextlib
+import datetime
 import json
 import os
 import pkg_resources
 import sqlite3
+import threading
+import time
 import unittest.mock
 
 import celery
+import celery.exceptions
 import falcon
 import pytest
 
 import brokkoly
+import brokkoly.batch
+import brokkoly.blob
+import brokkoly.circuit
+import brokkoly.coalesce
 import brokkoly.database
+import brokkoly.dead_letter
+import brokkoly.hook
+import brokkoly.priority
+import brokkoly.ratelimit
+import brokkoly.replay
 import brokkoly.retry
+import brokkoly.sampling
+import brokkoly.scheduler
 
 # We don't need actual celery for testing.
 celery.Celery = unittest.mock.MagicMock()
@@ -46,6 +64,150 @@ class TestBrokkoly:
         with pytest.raises(brokkoly.BrokkolyError):
             self.brokkoly.task()(task_for_test)
 
+    @pytest.mark.parametrize('serializer', ['json', 'msgpack'])
+    def test_claim_check(self, tmpdir, serializer):
+        received = []
+
+        def task_for_claim_check(data: str):
+            received.append(data)
+
+        store = brokkoly.blob.FileSystemBlobStore(str(tmpdir))
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            def mock_task(handle, bind):
+                self.handle = handle
+                return mock_celery_task
+
+            mock_celery_task = unittest.mock.MagicMock()
+            mock_celery.task.side_effect = mock_task
+            self.brokkoly.task(
+                serializer=serializer, claim_check=brokkoly.blob.ClaimCheck(100, store)
+            )(task_for_claim_check)
+
+        brokkoly._publish('test_queue', 'task_for_claim_check', {'data': "small"})
+        brokkoly._publish('test_queue', 'task_for_claim_check', {'data': "large" * 100})
+        small, large = [call[1]['kwargs'] for call in mock_celery_task.apply_async.call_args_list]
+        assert small == {'data': "small"}
+        assert list(large.keys()) == [brokkoly.blob.CLAIM_CHECK_KEY]
+        assert len(tmpdir.listdir()) == 1
+
+        self.handle(mock_celery_task, **small)
+        self.handle(mock_celery_task, **large)
+        assert received == ["small", "large" * 100]
+        assert len(tmpdir.listdir()) == 0
+
+    def test_file_system_blob_store_empty(self, tmpdir):
+        store = brokkoly.blob.FileSystemBlobStore(str(tmpdir.join('blobs')))
+        key = store.put(b"")
+        with store.open(key) as buffer:
+            assert bytes(buffer) == b""
+        store.delete(key)
+        store.delete(key)
+
+    def test_hooks(self, tmpdir):
+        timing_hook = brokkoly.hook.TimingHook()
+        profile_hook = brokkoly.hook.ProfileHook(str(tmpdir), rate=1, dump_every=2)
+        self.brokkoly.hooks.extend([timing_hook, profile_hook])
+
+        def task_for_hooks(fail: bool):
+            if fail:
+                raise Exception
+
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            def mock_task(handle, bind):
+                self.handle = handle
+
+            mock_celery.task.side_effect = mock_task
+            self.brokkoly.task()(task_for_hooks)
+
+        mock_celery_task = unittest.mock.MagicMock()
+        mock_celery_task.request.retries = 3
+        mock_celery_task.request.eta = None
+        setattr(mock_celery_task.request, brokkoly.hook.PUBLISHED_AT_HEADER, time.time() - 10)
+        self.handle(mock_celery_task, fail=False)
+        # The message was published 100 seconds ago with countdown, and became ready 10 seconds
+        # ago.
+        mock_celery_task.request.retries = 0
+        mock_celery_task.request.eta = datetime.datetime.fromtimestamp(
+            time.time() - 10, datetime.timezone.utc).isoformat()
+        setattr(mock_celery_task.request, brokkoly.hook.PUBLISHED_AT_HEADER, time.time() - 100)
+        with pytest.raises(Exception):
+            self.handle(mock_celery_task, fail=True)
+
+        stats = timing_hook.stats['task_for_hooks']
+        assert stats.count == 2
+        assert stats.failures == 1
+        assert stats.retried == 1
+        assert 20 <= stats.wait < 30
+        assert tmpdir.join('test_queue.task_for_hooks.{}.prof'.format(os.getpid())).check()
+
+    def _register_coroutine(self, f, retry_policy=None):
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            def mock_task(handle, bind):
+                self.handle = handle
+
+            mock_celery.task.side_effect = mock_task
+            mock_celery.conf.task_acks_late = False
+            self.brokkoly.task(retry_policy=retry_policy)(f)
+
+    def test_coroutine(self):
+        received = []
+
+        async def task_for_coroutine(number: int):
+            await asyncio.sleep(0.01)
+            received.append(number)
+
+        self._register_coroutine(task_for_coroutine)
+        for number in range(3):
+            assert self.handle(unittest.mock.MagicMock(), number=number) is None
+        self.brokkoly.event_loop.drain()
+
+        assert sorted(received) == [0, 1, 2]
+
+    def test_coroutine_retry(self):
+        async def task_for_coroutine_retry():
+            raise Exception
+
+        self._register_coroutine(task_for_coroutine_retry, brokkoly.retry.FibonacciWait(1))
+        mock_celery_task = unittest.mock.MagicMock()
+        mock_celery_task.request.retries = 0
+        self.handle(mock_celery_task)
+        self.brokkoly.event_loop.drain()
+
+        assert mock_celery_task.apply_async.call_args[1]['retries'] == 1
+
+    def test_coroutine_hooks(self, tmpdir):
+        profile_hook = brokkoly.hook.ProfileHook(str(tmpdir), rate=1, dump_every=1)
+        self.brokkoly.hooks.append(profile_hook)
+
+        async def task_for_coroutine_hooks():
+            await asyncio.sleep(0.01)
+
+        self._register_coroutine(task_for_coroutine_hooks)
+        self.handle(unittest.mock.MagicMock())
+        self.brokkoly.event_loop.drain()
+
+        assert not tmpdir.listdir()
+
+    def test_coroutine_acks_late(self):
+        async def task_for_coroutine_acks_late():
+            pass
+
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            mock_celery.conf.task_acks_late = True
+            with pytest.raises(brokkoly.BrokkolyError):
+                self.brokkoly.task()(task_for_coroutine_acks_late)
+
+    def test_coroutine_batch(self):
+        async def task_for_coroutine_batch(messages):
+            pass
+
+        with pytest.raises(brokkoly.BrokkolyError):
+            self.brokkoly.task(batch=brokkoly.batch.Batch(10, 1))(task_for_coroutine_batch)
+
+    def test_unsupported_serializer(self):
+        with pytest.raises(brokkoly.BrokkolyError):
+            self.brokkoly.task(serializer='pickle')(task_for_test)
+
     def test_queue_name_startw_with__(self):
         with pytest.raises(brokkoly.BrokkolyError):
             brokkoly.Brokkoly('_queue', 'test_broker')
@@ -80,6 +242,190 @@ class TestBrokkoly:
                 self.handle(mock_celery_task)
             assert not mock_celery_task.retry.called
 
+    def test_circuit_breaker(self):
+        def task_for_circuit_breaker(number: int):
+            raise Exception
+
+        circuit_breaker = brokkoly.circuit.CircuitBreaker(min_calls=2, open_for=30)
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            def mock_task(handle, bind):
+                self.handle = handle
+
+            mock_celery.task.side_effect = mock_task
+            self.brokkoly.task(circuit_breaker=circuit_breaker)(task_for_circuit_breaker)
+            mock_celery_task = unittest.mock.MagicMock()
+            mock_celery_task.request.retries = 0
+            for _ in range(2):
+                with pytest.raises(Exception):
+                    self.handle(mock_celery_task, number=1)
+            assert circuit_breaker.state == brokkoly.circuit.State.open
+
+            self.handle(mock_celery_task, number=1)
+            mock_celery_task.apply_async.assert_called_once_with(
+                kwargs={'number': 1}, serializer='json', compression='zlib',
+                countdown=unittest.mock.ANY, retries=0, headers=unittest.mock.ANY)
+            assert 0 < mock_celery_task.apply_async.call_args[1]['countdown'] <= 31
+
+    def test_circuit_breaker_half_open(self):
+        circuit_breaker = brokkoly.circuit.CircuitBreaker(min_calls=2, open_for=30, probes=1)
+        with unittest.mock.patch('time.monotonic') as mock_monotonic:
+            mock_monotonic.return_value = 100.0
+            circuit_breaker.record(True)
+            circuit_breaker.record(False)
+            assert circuit_breaker.state == brokkoly.circuit.State.open
+            assert not circuit_breaker.allow()
+
+            mock_monotonic.return_value = 130.0
+            assert circuit_breaker.allow()
+            assert not circuit_breaker.allow()
+            circuit_breaker.record(False)
+            assert circuit_breaker.state == brokkoly.circuit.State.open
+
+            mock_monotonic.return_value = 160.0
+            assert circuit_breaker.allow()
+            circuit_breaker.record(True)
+            assert circuit_breaker.state == brokkoly.circuit.State.closed
+            assert circuit_breaker.allow()
+
+    def test_dead_letter(self, tmpdir):
+        database = str(tmpdir.join('brokkoly.db'))
+        b = brokkoly.Brokkoly(
+            'test_queue', 'test_broker',
+            dead_letters=brokkoly.dead_letter.DatabaseDeadLetterStore(database))
+
+        def task_for_dead_letter(number: int):
+            raise ValueError("Invalid number")
+
+        with unittest.mock.patch.object(b, 'celery') as mock_celery:
+            def mock_task(handle, bind):
+                self.handle = handle
+
+            mock_celery.task.side_effect = mock_task
+            b.task(retry_policy=brokkoly.retry.FibonacciWait(2))(task_for_dead_letter)
+            mock_celery_task = unittest.mock.MagicMock()
+            mock_celery_task.request.retries = 1
+            self.handle(mock_celery_task, number=1)
+            mock_celery_task.request.retries = 2
+            self.handle(mock_celery_task, number=1)
+
+        with contextlib.closing(sqlite3.connect(database)) as connection:
+            rows = connection.execute(
+                "SELECT queue_name, task_name, message, error_type, error, retries "
+                "FROM dead_letters"
+            ).fetchall()
+        assert rows == [(
+            'test_queue', 'task_for_dead_letter', b'{"number": 1}', 'ValueError',
+            "Invalid number", 2
+        )]
+
+    def _register_batch(self, f, retry_policy=None, circuit_breaker=None):
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            def mock_task(handle, bind, **options):
+                self.handle = handle
+                self.options = options
+
+            mock_celery.task.side_effect = mock_task
+            self.brokkoly.task(
+                retry_policy=retry_policy, circuit_breaker=circuit_breaker,
+                batch=brokkoly.batch.Batch(500, 1)
+            )(f)
+
+    def _batch_request(self, kwargs, retries=0):
+        return unittest.mock.MagicMock(kwargs=kwargs, request_dict={'retries': retries})
+
+    def test_batch(self):
+        received = []
+        self._register_batch(lambda messages: received.append(messages))
+        assert self.options['flush_every'] == 500
+        assert self.options['flush_interval'] == 1
+        assert self.options['acks_late']
+        assert self.brokkoly._tasks['<lambda>'][0].validation is None
+
+        self.handle(unittest.mock.MagicMock(), [
+            self._batch_request({'number': 1}), self._batch_request({'number': 2})])
+        assert received == [[{'number': 1}, {'number': 2}]]
+
+    def test_batch_retry_message(self):
+        def task_for_batch_retry(messages):
+            if any(message['number'] == 2 for message in messages):
+                raise Exception
+
+        self._register_batch(task_for_batch_retry, brokkoly.retry.FibonacciWait(3))
+        mock_celery_task = unittest.mock.MagicMock()
+        self.handle(mock_celery_task, [
+            self._batch_request({'number': 1}), self._batch_request({'number': 2}, retries=1)])
+
+        mock_celery_task.apply_async.assert_called_once_with(
+            kwargs={'number': 2}, serializer='json', compression='zlib', countdown=2, retries=2,
+            headers=unittest.mock.ANY)
+
+    def test_batch_retry_bisect(self):
+        called = []
+
+        def task_for_batch_retry(messages):
+            called.append(len(messages))
+            if any(message['number'] == 5 for message in messages):
+                raise Exception
+
+        self._register_batch(task_for_batch_retry, brokkoly.retry.FibonacciWait(3))
+        mock_celery_task = unittest.mock.MagicMock()
+        self.handle(mock_celery_task, [self._batch_request({'number': n}) for n in range(8)])
+
+        mock_celery_task.apply_async.assert_called_once_with(
+            kwargs={'number': 5}, serializer='json', compression='zlib', countdown=1, retries=1,
+            headers=unittest.mock.ANY)
+        assert called == [8, 4, 4, 2, 2, 1, 1]
+
+    def test_batch_retry_bisect_all_failed(self):
+        called = []
+
+        def task_for_batch_retry(messages):
+            called.append(len(messages))
+            raise Exception
+
+        timing_hook = brokkoly.hook.TimingHook()
+        self.brokkoly.hooks.append(timing_hook)
+        circuit_breaker = brokkoly.circuit.CircuitBreaker(min_calls=100)
+        self._register_batch(
+            task_for_batch_retry, brokkoly.retry.FibonacciWait(3), circuit_breaker)
+        mock_celery_task = unittest.mock.MagicMock()
+        self.handle(mock_celery_task, [self._batch_request({'number': n}) for n in range(8)])
+
+        # Both halves fail, so it doesn't bisect them more and retries all messages.
+        assert called == [8, 4, 4]
+        assert mock_celery_task.apply_async.call_count == 8
+        assert timing_hook.stats['task_for_batch_retry'].failures == 16
+        assert circuit_breaker._failures == 3
+
+    def test_batch_message_type(self):
+        def message_type(number: int):
+            pass
+
+        with unittest.mock.patch.object(self.brokkoly, 'celery') as mock_celery:
+            mock_celery.task.side_effect = lambda handle, bind, **options: None
+            self.brokkoly.task(batch=brokkoly.batch.Batch(500, 1, message_type))(
+                lambda messages: None)
+
+        (_, validation), preprocessors = self.brokkoly._tasks['<lambda>']
+        assert validation == [('number', int)]
+        with pytest.raises(falcon.HTTPBadRequest):
+            brokkoly._prepare_kwargs({'number': "1"}, validation, preprocessors)
+
+    def test_batch_retry_batch(self):
+        def task_for_batch_retry(messages):
+            raise Exception
+
+        self._register_batch(task_for_batch_retry, brokkoly.retry.FibonacciWait(
+            1, retry_unit=brokkoly.retry.RetryUnit.batch))
+        mock_celery_task = unittest.mock.MagicMock()
+        with pytest.raises(Exception):
+            self.handle(mock_celery_task, [
+                self._batch_request({'number': 1}), self._batch_request({'number': 2}, retries=1)])
+
+        mock_celery_task.apply_async.assert_called_once_with(
+            kwargs={'number': 1}, serializer='json', compression='zlib', countdown=1, retries=1,
+            headers=unittest.mock.ANY)
+
 
 class TestProducer:
     def setup_method(self, method):
@@ -88,6 +434,7 @@ class TestProducer:
         self.producer = brokkoly.Producer(brokkoly.HTMLRendler())
         self.mock_req = unittest.mock.MagicMock()
         self.mock_resp = unittest.mock.MagicMock()
+        self.mock_req.get_param_as_float.return_value = None
         brokkoly.database.Migrator(brokkoly.__version__).migrate()
         brokkoly.database.db.reconnect()
 
@@ -104,10 +451,13 @@ class TestProducer:
         assert e.value.title == "Undefined queue"
 
     def test_undefined_task(self):
-        with pytest.raises(falcon.HTTPBadRequest) as e:
-            self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'undefined_task')
+        with unittest.mock.patch.object(brokkoly.logger, 'warning') as mock_warning:
+            with pytest.raises(falcon.HTTPBadRequest) as e:
+                self.producer.on_post(
+                    self.mock_req, self.mock_resp, 'test_queue', 'undefined_task')
 
         assert e.value.title == "Undefined task"
+        assert mock_warning.called
 
     def test_empty_payload(self):
         self.mock_req.stream.read.return_value = b""
@@ -125,10 +475,20 @@ class TestProducer:
 
     def test_lack_message(self):
         self.mock_req.stream.read.return_value = b"{}"
+        with unittest.mock.patch.object(brokkoly.logger, 'warning') as mock_warning:
+            with pytest.raises(falcon.HTTPBadRequest) as e:
+                self.producer.on_post(
+                    self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        assert e.value.title == "Invalid JSON"
+        assert mock_warning.call_args[0][3] == "JSON must have message field"
+
+    def test_non_object_payload(self):
+        self.mock_req.stream.read.return_value = b"[]"
         with pytest.raises(falcon.HTTPBadRequest) as e:
             self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
 
-        assert e.value.title == "Invalid JSON"
+        assert e.value.description == "JSON must be an object"
 
     def test_preprocessor_lack_requirements(self):
         def preprocessor_for_preprocessor_test(text: str):
@@ -166,6 +526,29 @@ class TestProducer:
 
         assert e.value.title == "Invalid type"
 
+    def test_coroutine_preprocessor(self):
+        async def preprocessor_for_preprocessor_test(number: int):
+            return {
+                'text': str(number)
+            }
+
+        @self.brokkoly.task(preprocessor_for_preprocessor_test)
+        def task_for_preprocessor_test(text: str):
+            pass
+
+        self.mock_req.stream.read.return_value = json.dumps({
+            'message': {
+                'number': 1
+            }
+        }).encode()
+        task = self.brokkoly._tasks['task_for_preprocessor_test'][0][0]
+        task.apply_async.reset_mock()
+
+        self.producer.on_post(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_preprocessor_test')
+
+        assert task.apply_async.call_args[1]['kwargs'] == {'text': "1"}
+
     def test_task(self):
         def preprocessor_for_preprocessor_test(number: int):
             return {
@@ -187,10 +570,644 @@ class TestProducer:
 
         assert self.brokkoly._tasks['task_for_preprocessor_test'][0][0].apply_async.called
 
+    def _set_params(self, params):
+        self.mock_req.get_param.side_effect = params.get
+        self.mock_req.get_param_as_int.side_effect = params.get
+
+    def test_msgpack_payload(self):
+        import msgpack
+
+        @self.brokkoly.task(serializer='msgpack')
+        def task_for_msgpack_test(data: bytes):
+            pass
+
+        self.mock_req.content_type = 'application/msgpack'
+        self.mock_req.stream.read.return_value = msgpack.packb({
+            'message': {'data': b"\x00\x01"}
+        }, use_bin_type=True)
+        task = self.brokkoly._tasks['task_for_msgpack_test'][0][0]
+        task.apply_async.reset_mock()
+
+        self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_msgpack_test')
+
+        task.apply_async.assert_called_once_with(
+            kwargs={'data': b"\x00\x01"}, serializer='msgpack', compression='zlib', countdown=0,
+            headers={brokkoly.hook.PUBLISHED_AT_HEADER: unittest.mock.ANY})
+        message_log, = brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+            'test_queue', 'task_for_msgpack_test')
+        assert json.loads(message_log.message) == {'data': "AAE="}
+        assert message_log.load_message() == {'data': b"\x00\x01"}
+
+    def test_non_msgpack_payload(self):
+        self.mock_req.content_type = 'application/msgpack'
+        self.mock_req.stream.read.return_value = b"\xc1"
+        with pytest.raises(falcon.HTTPBadRequest) as e:
+            self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        assert e.value.title == "Payload is not a MessagePack"
+
+    def test_coalesce(self):
+        coalescer = unittest.mock.MagicMock()
+        producer = brokkoly.Producer(brokkoly.HTMLRendler(), coalescer=coalescer)
+        coalesce = brokkoly.coalesce.Coalesce(lambda kwargs: kwargs['number'], 1)
+
+        @self.brokkoly.task(coalesce=coalesce)
+        def task_for_coalesce_test(number: int):
+            pass
+
+        self.mock_req.stream.read.return_value = json.dumps({'message': {'number': 1}}).encode()
+        producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_coalesce_test')
+        coalescer.add.assert_called_once_with(
+            coalesce, 'test_queue', 'task_for_coalesce_test', {'number': 1}, serializer='json')
+
+        self.mock_req.stream.read.return_value = json.dumps({
+            'message': {'number': 1},
+            'delay': 10,
+        }).encode()
+        with pytest.raises(falcon.HTTPBadRequest) as e:
+            producer.on_post(
+                self.mock_req, self.mock_resp, 'test_queue', 'task_for_coalesce_test')
+        assert e.value.title == "Invalid delay"
+
+    def _list_messages(self, task_name):
+        return [
+            json.loads(message_log.message) for message_log in
+            brokkoly.database.MessageLog.list_by_queue_name_and_task_name('test_queue', task_name)
+        ]
+
+    def test_sampling(self):
+        @self.brokkoly.task(sampling=brokkoly.sampling.OneInN(2))
+        def task_for_sampling_test(number: int):
+            pass
+
+        for number in range(3):
+            self.mock_req.stream.read.return_value = json.dumps({
+                'message': {'number': number}
+            }).encode()
+            self.producer.on_post(
+                self.mock_req, self.mock_resp, 'test_queue', 'task_for_sampling_test')
+
+        assert self._list_messages('task_for_sampling_test') == [{'number': 2}, {'number': 0}]
+
+        self.mock_req.stream.read.return_value = json.dumps({'message': {}}).encode()
+        with pytest.raises(falcon.HTTPBadRequest):
+            self.producer.on_post(
+                self.mock_req, self.mock_resp, 'test_queue', 'task_for_sampling_test')
+
+    def test_reservoir_sampling(self):
+        reservoir = brokkoly.sampling.Reservoir(2)
+        for number in range(100):
+            reservoir.log('test_queue', 'task_for_test', {'number': number})
+
+        messages = self._list_messages('task_for_test')
+        assert len(messages) == 2
+        assert all(message in [{'number': n} for n in range(100)] for message in messages)
+
+    def test_dead_letters(self):
+        for number, error_type in [(0, 'ValueError'), (1, 'KeyError'), (2, 'ValueError')]:
+            brokkoly.database.DeadLetter.create(
+                'test_queue', 'task_for_test', json.dumps({'number': number}).encode(), 'json',
+                error_type, "error", 3
+            )
+        self._set_params({})
+        self.mock_req.client_prefers.return_value = 'application/json'
+
+        brokkoly.DeadLetterResource(brokkoly.HTMLRendler()).on_get(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        body = json.loads(self.mock_resp.body)
+        assert body['groups'] == [
+            {'error_type': 'ValueError', 'count': 2}, {'error_type': 'KeyError', 'count': 1}]
+        assert [d['message'] for d in body['dead_letters']] == [
+            {'number': 2}, {'number': 1}, {'number': 0}]
+
+        task = self.brokkoly._tasks['task_for_test'][0][0]
+        task.apply_async.reset_mock()
+        self.mock_req.stream.read.return_value = json.dumps({'error_type': 'ValueError'}).encode()
+        brokkoly.DeadLetterRequeueResource(None).on_post(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        assert json.loads(self.mock_resp.body) == {'requeued': 2}
+        assert [c[1]['kwargs'] for c in task.apply_async.call_args_list] == [
+            {'number': 2}, {'number': 0}]
+        assert brokkoly.database.DeadLetter.count_by_error_type(
+            'test_queue', 'task_for_test') == [('KeyError', 1)]
+
+        self.mock_req.client_prefers.return_value = 'text/html'
+        brokkoly.DeadLetterResource(brokkoly.HTMLRendler()).on_get(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+        assert self.mock_resp.content_type == 'text/html'
+
+    def test_requeue_rate(self):
+        for number in range(3):
+            brokkoly.database.DeadLetter.create(
+                'test_queue', 'task_for_test', json.dumps({'number': number}).encode(), 'json',
+                'ValueError', "error", 3
+            )
+        brokkoly.database.db.get().commit()
+        in_transaction = []
+
+        def acquire(limiter):
+            in_transaction.append(brokkoly.database.db.get().in_transaction)
+
+        with unittest.mock.patch.object(brokkoly.ratelimit.RateLimiter, 'acquire', acquire):
+            assert brokkoly.dead_letter.requeue('test_queue', 'task_for_test', rate=1) == 3
+
+        # It doesn't wait while holding the write transaction.
+        assert in_transaction == [False, False, False]
+
+    def test_requeue_invalid_ids(self):
+        self.mock_req.stream.read.return_value = json.dumps({'ids': "1"}).encode()
+        with pytest.raises(falcon.HTTPBadRequest) as e:
+            brokkoly.DeadLetterRequeueResource(None).on_post(
+                self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        assert e.value.title == "Invalid type"
+
+    def _register_waitable(self):
+        b = brokkoly.Brokkoly('test_queue', 'test_broker', backend='rpc://')
+
+        @b.task()
+        def task_for_wait_test(text: str, number: int):
+            pass
+
+        @b.task(circuit_breaker=brokkoly.circuit.CircuitBreaker())
+        def task_for_wait_circuit_test(text: str, number: int):
+            pass
+
+        self.mock_req.stream.read.return_value = json.dumps({
+            'message': {'text': "text", 'number': 1}
+        }).encode()
+        task = self.brokkoly._tasks['task_for_wait_test'][0][0]
+        task.apply_async.reset_mock()
+        return task.apply_async.return_value
+
+    def test_wait(self):
+        async_result = self._register_waitable()
+        async_result.id = 'task_id'
+        async_result.state = 'SUCCESS'
+        async_result.failed.return_value = False
+        self.mock_req.get_param_as_float.return_value = 1.5
+
+        def get(**kwargs):
+            # The message log is committed before waiting.
+            assert not brokkoly.database.db.get().in_transaction
+            return 2
+
+        async_result.get.side_effect = get
+        self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_wait_test')
+
+        async_result.get.assert_called_once_with(timeout=1.5, propagate=False)
+        assert self.mock_resp.status == falcon.HTTP_200
+        assert json.loads(self.mock_resp.body) == {
+            'task_id': 'task_id', 'status': 'SUCCESS', 'result': 2}
+
+    def test_wait_timeout(self):
+        async_result = self._register_waitable()
+        async_result.id = 'task_id'
+        async_result.get.side_effect = celery.exceptions.TimeoutError
+        self.mock_req.get_param_as_float.return_value = 1
+
+        self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_wait_test')
+
+        assert self.mock_resp.status == falcon.HTTP_202
+        assert json.loads(self.mock_resp.body) == {'task_id': 'task_id'}
+
+    @pytest.mark.parametrize('task_name,wait', [
+        ('task_for_test', 1),
+        ('task_for_wait_test', 0),
+        ('task_for_wait_test', 31),
+        ('task_for_wait_circuit_test', 1),
+    ])
+    def test_invalid_wait(self, task_name, wait):
+        self._register_waitable()
+        self.mock_req.get_param_as_float.return_value = wait
+
+        with pytest.raises(falcon.HTTPBadRequest) as e:
+            self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', task_name)
+
+        assert e.value.title == "Invalid wait"
+
+    def test_priority(self):
+        @self.brokkoly.task(priority=brokkoly.priority.Priority((1, 4, 16), default=1, maximum=1))
+        def task_for_priority_test(number: int):
+            pass
+
+        task = self.brokkoly._tasks['task_for_priority_test'][0][0]
+        for priority, lane in [(0, 0), (None, 1)]:
+            task.apply_async.reset_mock()
+            self.mock_req.stream.read.return_value = json.dumps({
+                'message': {'number': 1},
+                'priority': priority,
+            }).encode()
+            self.producer.on_post(
+                self.mock_req, self.mock_resp, 'test_queue', 'task_for_priority_test')
+
+            assert task.apply_async.call_args[1]['queue'] == \
+                "test_queue.task_for_priority_test.priority.{}".format(lane)
+
+    @pytest.mark.parametrize('task_name,priority', [
+        ('task_for_priority_test', 2),
+        ('task_for_priority_test', "1"),
+        ('task_for_test', 0),
+    ])
+    def test_invalid_priority(self, task_name, priority):
+        @self.brokkoly.task(priority=brokkoly.priority.Priority((1, 4, 16), maximum=1))
+        def task_for_priority_test(text: str, number: int):
+            pass
+
+        self.mock_req.stream.read.return_value = json.dumps({
+            'message': {'text': "text", 'number': 1},
+            'priority': priority,
+        }).encode()
+        with pytest.raises(falcon.HTTPBadRequest) as e:
+            self.producer.on_post(self.mock_req, self.mock_resp, 'test_queue', task_name)
+
+        assert e.value.title == "Invalid priority"
+
     def test_on_get(self):
+        self._set_params({})
         self.producer.on_get(self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
         self.mock_resp.content_type = 'text/html'
 
+    def _create_message_logs(self, messages):
+        for message in messages:
+            brokkoly.database.MessageLog.create(
+                'test_queue', 'task_for_test', json.dumps(message))
+
+    def test_search_message_logs(self):
+        self._create_message_logs([
+            {'customer_id': "cus_0001"}, {'customer_id': "cus_0002"}, {'customer_id': "cus_0001"}
+        ])
+        self._set_params({'q': "cus_0001"})
+
+        brokkoly.MessageLogResource().on_get(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        body = json.loads(self.mock_resp.body)
+        assert [m['message'] for m in body['messages']] == [{'customer_id': "cus_0001"}] * 2
+        assert body['messages'][0]['id'] > body['messages'][1]['id']
+        assert body['next_before'] is None
+
+    def test_search_message_logs_after_eliminate(self):
+        self._create_message_logs([{'customer_id': "cus_0001"}])
+        brokkoly.database.db.get().execute("DELETE FROM message_logs")
+
+        assert not list(brokkoly.database.MessageLog.search(
+            'test_queue', 'task_for_test', "cus_0001"))
+
+    @unittest.mock.patch.object(brokkoly, 'MESSAGE_LOG_PAGE_SIZE', 2)
+    def test_list_message_logs_pagination(self):
+        self._create_message_logs([{'number': number} for number in range(3)])
+        self._set_params({})
+
+        brokkoly.MessageLogResource().on_get(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+        body = json.loads(self.mock_resp.body)
+        assert [m['message'] for m in body['messages']] == [{'number': 2}, {'number': 1}]
+
+        self._set_params({'before': body['next_before']})
+        brokkoly.MessageLogResource().on_get(
+            self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+        body = json.loads(self.mock_resp.body)
+        assert [m['message'] for m in body['messages']] == [{'number': 0}]
+        assert body['next_before'] is None
+
+    def test_delay_over_threshold(self):
+        scheduler = brokkoly.scheduler.DelayScheduler(60, unittest.mock.MagicMock())
+        producer = brokkoly.Producer(brokkoly.HTMLRendler(), scheduler)
+        self.mock_req.stream.read.return_value = json.dumps({
+            'message': {'text': "text", 'number': 1},
+            'delay': 3600,
+        }).encode()
+        # Celery is mocked, tasks share the same mock.
+        self.brokkoly._tasks['task_for_test'][0][0].apply_async.reset_mock()
+
+        producer.on_post(self.mock_req, self.mock_resp, 'test_queue', 'task_for_test')
+
+        assert not self.brokkoly._tasks['task_for_test'][0][0].apply_async.called
+        delayed_messages = list(brokkoly.database.DelayedMessage.list_due_before(float('inf')))
+        assert len(delayed_messages) == 1
+        assert delayed_messages[0].serializer == 'json'
+        assert json.loads(delayed_messages[0].message) == {'text': "text", 'number': 1}
+
+
+class TestReplay:
+    def setup_method(self, method):
+        self.brokkoly = brokkoly.Brokkoly('test_queue', 'test_broker')
+        self.brokkoly.task()(task_for_test)
+        brokkoly.database.Migrator(brokkoly.__version__).migrate()
+        brokkoly.database.db.reconnect()
+        for message in [
+                {'text': "a", 'number': 1}, {'text': "b", 'number': "invalid"},
+                {'text': "c", 'number': 3}, {'text': "a", 'number': 4},
+        ]:
+            brokkoly.database.MessageLog.create(
+                'test_queue', 'task_for_test', json.dumps(message))
+
+    def teardown_method(self, method):
+        brokkoly._tasks.clear()
+        brokkoly.database.db.get().close()
+        os.remove('test.db')
+
+    @unittest.mock.patch.object(brokkoly, '_publish')
+    def test_replay(self, mock_publish):
+        progress = unittest.mock.MagicMock()
+        result = brokkoly.replay.replay(
+            'test_queue', 'task_for_test', concurrency=2, progress=progress, progress_every=2)
+
+        assert result == brokkoly.replay.Progress(3, 1)
+        assert sorted(call[0][2]['number'] for call in mock_publish.call_args_list) == [1, 3, 4]
+        assert progress.call_count == 3
+        progress.assert_called_with(result)
+
+    @unittest.mock.patch.object(brokkoly, '_publish')
+    def test_replay_filter(self, mock_publish):
+        result = brokkoly.replay.replay('test_queue', 'task_for_test', min_id=2, text="a")
+
+        assert result == brokkoly.replay.Progress(1, 0)
+        mock_publish.assert_called_once_with(
+            'test_queue', 'task_for_test', {'text': "a", 'number': 4})
+
+    @unittest.mock.patch.object(brokkoly, '_publish')
+    def test_replay_msgpack(self, mock_publish):
+        @self.brokkoly.task(serializer='msgpack')
+        def task_for_msgpack_test(data: bytes):
+            pass
+
+        brokkoly.sampling.Always().log(
+            'test_queue', 'task_for_msgpack_test', {'data': b"\x00\x01"}, 'msgpack')
+        result = brokkoly.replay.replay('test_queue', 'task_for_msgpack_test')
+
+        assert result == brokkoly.replay.Progress(1, 0)
+        mock_publish.assert_called_once_with(
+            'test_queue', 'task_for_msgpack_test', {'data': b"\x00\x01"})
+
+    def test_replay_undefined_task(self):
+        with pytest.raises(brokkoly.BrokkolyError):
+            brokkoly.replay.replay('test_queue', 'undefined_task')
+
+    def test_iterate_chunk(self):
+        message_logs = brokkoly.database.MessageLog.iterate(
+            'test_queue', 'task_for_test', max_id=3, chunk_size=2)
+        assert [message_log.id for message_log in message_logs] == [1, 2, 3]
+
+
+class TestCoalescer:
+    def setup_method(self, method):
+        brokkoly.database.Migrator(brokkoly.__version__).migrate()
+        brokkoly.database.db.reconnect()
+        self.publish = unittest.mock.MagicMock()
+        self.coalescer = brokkoly.coalesce.Coalescer(self.publish)
+
+    def teardown_method(self, method):
+        brokkoly.database.db.get().close()
+        os.remove('test.db')
+
+    @pytest.mark.parametrize('shared', [False, True])
+    def test_last_write_wins(self, shared):
+        coalesce = brokkoly.coalesce.Coalesce(lambda kwargs: kwargs['id'], 10, shared=shared)
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            for id, version in [(1, 1), (2, 1), (1, 2)]:
+                self.coalescer.add(
+                    coalesce, 'test_queue', 'task_for_test', {'id': id, 'version': version})
+        with unittest.mock.patch('time.time', return_value=now + 5):
+            self.coalescer.add(coalesce, 'test_queue', 'task_for_test', {'id': 1, 'version': 3})
+
+        self.coalescer.run_pending(now + 9)
+        assert not self.publish.called
+
+        self.coalescer.run_pending(now + 10)
+        assert sorted(call[0][2]['id'] for call in self.publish.call_args_list) == [1, 2]
+        self.publish.assert_any_call('test_queue', 'task_for_test', {'id': 1, 'version': 3})
+
+        self.publish.reset_mock()
+        self.coalescer.run_pending(now + 20)
+        assert not self.publish.called
+
+    @pytest.mark.parametrize('shared', [False, True])
+    def test_merge(self, shared):
+        coalesce = brokkoly.coalesce.Coalesce(
+            lambda kwargs: 'all', 10, shared=shared,
+            merge=lambda old, new: {'ids': old['ids'] + new['ids']}
+        )
+        for id in range(3):
+            self.coalescer.add(coalesce, 'test_queue', 'task_for_test', {'ids': [id]})
+
+        self.coalescer.run_pending(time.time() + 10)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'ids': [0, 1, 2]})
+
+    def test_msgpack(self):
+        coalesce = brokkoly.coalesce.Coalesce(
+            lambda kwargs: 'all', 10, shared=True,
+            merge=lambda old, new: {'data': old['data'] + new['data']}
+        )
+        for data in [b"\x00", b"\x01"]:
+            self.coalescer.add(
+                coalesce, 'test_queue', 'task_for_test', {'data': data}, serializer='msgpack')
+
+        self.coalescer.run_pending(time.time() + 10)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'data': b"\x00\x01"})
+
+    @pytest.mark.parametrize('shared', [False, True])
+    def test_publish_error(self, shared):
+        coalesce = brokkoly.coalesce.Coalesce(
+            lambda kwargs: 'all', 10, shared=shared,
+            merge=lambda old, new: {'ids': old['ids'] + new['ids']}
+        )
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            self.coalescer.add(coalesce, 'test_queue', 'task_for_test', {'ids': [0]})
+        brokkoly.database.db.get().commit()
+
+        self.publish.side_effect = Exception
+        self.coalescer.run_pending(now + 10)
+        with unittest.mock.patch('time.time', return_value=now + 10):
+            self.coalescer.add(coalesce, 'test_queue', 'task_for_test', {'ids': [1]})
+
+        self.publish.reset_mock()
+        self.publish.side_effect = None
+        self.coalescer.run_pending(now + 11)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'ids': [0, 1]})
+
+
+class TestDelayScheduler:
+    def setup_method(self, method):
+        brokkoly.database.Migrator(brokkoly.__version__).migrate()
+        brokkoly.database.db.reconnect()
+        self.publish = unittest.mock.MagicMock()
+        self.scheduler = brokkoly.scheduler.DelayScheduler(60, self.publish)
+
+    def teardown_method(self, method):
+        brokkoly.database.db.get().close()
+        os.remove('test.db')
+
+    def test_run_pending(self):
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            self.scheduler.schedule('test_queue', 'task_for_test', {'number': 1}, 100)
+            self.scheduler.schedule('test_queue', 'task_for_test', {'number': 2}, 1000)
+
+        self.scheduler.run_pending(now)
+        self.scheduler.run_pending(now + 99)
+        assert not self.publish.called
+
+        self.scheduler.run_pending(now + 100)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'number': 1})
+        assert len(list(brokkoly.database.DelayedMessage.list_due_before(float('inf')))) == 1
+
+    def test_run_pending_msgpack(self):
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            self.scheduler.schedule(
+                'test_queue', 'task_for_test', {'data': b"\x00\x01"}, 100, serializer='msgpack')
+
+        self.scheduler.run_pending(now)
+        self.scheduler.run_pending(now + 100)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'data': b"\x00\x01"})
+
+    def test_run_pending_overdue(self):
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now - 1000):
+            self.scheduler.schedule('test_queue', 'task_for_test', {'number': 1}, 100)
+
+        self.scheduler.run_pending(now)
+        self.publish.assert_called_once_with('test_queue', 'task_for_test', {'number': 1})
+
+    def test_run_pending_published_by_other(self):
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            self.scheduler.schedule('test_queue', 'task_for_test', {'number': 1}, 100)
+
+        self.scheduler.run_pending(now)
+        for delayed_message in brokkoly.database.DelayedMessage.list_due_before(float('inf')):
+            brokkoly.database.DelayedMessage.delete(delayed_message.id)
+        self.scheduler.run_pending(now + 100)
+        assert not self.publish.called
+
+    def test_run_pending_error(self):
+        now = 1000000.0
+        with unittest.mock.patch('time.time', return_value=now):
+            for number in range(3):
+                self.scheduler.schedule('test_queue', 'task_for_test', {'number': number}, 100)
+        brokkoly.database.db.get().commit()
+
+        self.scheduler.run_pending(now)
+        delete = brokkoly.database.DelayedMessage.delete
+        errors = [sqlite3.OperationalError("database is locked")]
+
+        def delete_or_raise(id):
+            if errors:
+                raise errors.pop()
+            return delete(id)
+
+        with unittest.mock.patch.object(
+                brokkoly.database.DelayedMessage, 'delete', side_effect=delete_or_raise):
+            self.scheduler.run_pending(now + 100)
+        assert self.publish.call_count == 2
+
+        # It is loaded again, and published at the next tick.
+        self.scheduler.run_pending(now + 110)
+        self.scheduler.run_pending(now + 111)
+        assert self.publish.call_count == 3
+        assert not list(brokkoly.database.DelayedMessage.list_due_before(float('inf')))
+
+    def test_run_pending_catch_up(self):
+        now = 1000000.0
+        for number in range(25):
+            with unittest.mock.patch('time.time', return_value=now - 1000 + number):
+                self.scheduler.schedule('test_queue', 'task_for_test', {'number': number}, 100)
+        brokkoly.database.db.get().commit()
+        scheduler = brokkoly.scheduler.DelayScheduler(
+            60, self.publish, max_loaded=10, max_publish=4, chunk_size=3)
+
+        for tick in range(10):
+            self.publish.reset_mock()
+            scheduler.run_pending(now + tick)
+            assert len(scheduler._loaded) <= 10
+            assert self.publish.call_count <= 4
+            published = [call[0][2]['number'] for call in self.publish.call_args_list]
+            if published:
+                assert published == sorted(published)
+
+        assert not list(brokkoly.database.DelayedMessage.list_due_before(float('inf')))
+
+    def test_threshold_shorter_than_interval(self):
+        with pytest.raises(brokkoly.BrokkolyError):
+            brokkoly.scheduler.DelayScheduler(1, self.publish)
+
+
+def test_rate_limiter():
+    rate_limiter = brokkoly.ratelimit.RateLimiter(100)
+    started_at = time.monotonic()
+    for _ in range(11):
+        rate_limiter.acquire()
+    assert time.monotonic() - started_at >= 0.1
+
+
+@unittest.mock.patch.dict(brokkoly.priority._weights, {'low': 1, 'high': 3})
+def test_weighted_cycle():
+    cycle = brokkoly.priority.WeightedCycle()
+    cycle.update(['low', 'high', 'celery'])
+    consumed = collections.Counter()
+    for _ in range(500):
+        queue = cycle.consume(3)[0]
+        consumed[queue] += 1
+        cycle.rotate(queue)
+    assert consumed == {'high': 300, 'low': 100, 'celery': 100}
+
+    # Empty lanes are skipped.
+    consumed.clear()
+    for _ in range(100):
+        queue = [queue for queue in cycle.consume(3) if queue != 'high'][0]
+        consumed[queue] += 1
+        cycle.rotate(queue)
+    # Credit left from the previous phase can shift one message.
+    assert sorted(consumed) == ['celery', 'low']
+    assert abs(consumed['low'] - consumed['celery']) <= 2
+
+
+def test_weighted_cycle_after_idle():
+    lanes = [brokkoly.priority.lane('test_queue', 'task', i) for i in range(3)]
+    for lane, weight in zip(lanes, [1, 4, 16]):
+        brokkoly.priority._weights[lane] = weight
+    cycle = brokkoly.priority.WeightedCycle()
+    cycle.update(lanes)
+    messages = {lanes[0]: 0, lanes[1]: 0, lanes[2]: 10000}
+
+    def consume():
+        # The broker returns a message from the first queue having one.
+        queue = [queue for queue in cycle.consume(3) if messages[queue]][0]
+        messages[queue] -= 1
+        cycle.rotate(queue)
+        return queue
+
+    for _ in range(10000):
+        assert consume() == lanes[2]
+
+    # Backfill comes to lower lanes. The highest lane keeps its share.
+    for lane in lanes:
+        messages[lane] = 10000
+    consumed = collections.Counter(consume() for _ in range(21))
+    assert consumed == {lanes[0]: 1, lanes[1]: 4, lanes[2]: 16}
+
+
+def test_timer_wheel():
+    wheel = brokkoly.scheduler.TimerWheel(0, slots=4, levels=3)
+    for due in [0, 3, 5, 17, 63]:
+        wheel.add(due, due)
+
+    with pytest.raises(ValueError):
+        wheel.add(64, 64)
+
+    fired = []
+    for now in range(64):
+        expired = wheel.advance(now)
+        assert all(due == now for due in expired)
+        fired.extend(expired)
+    assert fired == [0, 3, 5, 17, 63]
+
 
 class TestStaticResource:
     @unittest.mock.patch.object(pkg_resources, "resource_filename")
@@ -235,6 +1252,142 @@ class TestMigrator:
             migrator.migrate()
 
 
+class TestThreadLocalDBConnectionManager:
+    def setup_method(self, method):
+        self.connection_manager = brokkoly.database.ThreadLocalDBConnectionManager()
+
+    def teardown_method(self, method):
+        self.connection_manager.close()
+
+    def test_shard_message_logs(self, tmpdir):
+        self.connection_manager.dbname = str(tmpdir.join('brokkoly.db'))
+        self.connection_manager.shard_message_logs = True
+        with unittest.mock.patch.object(brokkoly.database, 'db', self.connection_manager):
+            brokkoly.database.Migrator(brokkoly.__version__).migrate()
+            self.connection_manager.reconnect()
+            for queue_name in ['first_queue', 'second/queue']:
+                brokkoly.database.MessageLog.create(queue_name, 'task', '{}')
+
+            assert len(self.connection_manager.get_shards()) == 2
+            for connection in self.connection_manager.get_shards():
+                connection.commit()
+            assert sorted(path.basename for path in tmpdir.listdir()) == [
+                'brokkoly.db', 'brokkoly.first_queue.db', 'brokkoly.second_queue.db']
+            assert not list(brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+                'third_queue', 'task'))
+
+    def test_shard_migration_from_threads(self, tmpdir):
+        self.connection_manager.dbname = str(tmpdir.join('brokkoly.db'))
+        self.connection_manager.shard_message_logs = True
+        with unittest.mock.patch.object(brokkoly.database, 'db', self.connection_manager):
+            brokkoly.database.Migrator(brokkoly.__version__).migrate()
+            barrier = threading.Barrier(4)
+            errors = []
+
+            def write():
+                self.connection_manager.reconnect()
+                try:
+                    barrier.wait()
+                    brokkoly.database.MessageLog.create('new_queue', 'task', '{}')
+                    self.connection_manager.get('new_queue').commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    self.connection_manager.close()
+
+            threads = [threading.Thread(target=write) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert not errors
+            self.connection_manager.reconnect()
+            assert len(list(brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+                'new_queue', 'task'))) == 4
+
+    def test_memory_snapshot(self, tmpdir):
+        snapshot = str(tmpdir.join('brokkoly.db'))
+        self.connection_manager.dbname = brokkoly.database.MEMORY
+        self.connection_manager.shard_message_logs = True
+        with unittest.mock.patch.object(brokkoly.database, 'db', self.connection_manager):
+            brokkoly.database.Migrator(brokkoly.__version__).migrate()
+            self.connection_manager.reconnect()
+            brokkoly.database.MessageLog.create('snapshot_queue', 'task', '{"number": 1}')
+            self.connection_manager.get('snapshot_queue').commit()
+            self.connection_manager.snapshot(snapshot)
+            assert tmpdir.join('brokkoly.snapshot_queue.db').check()
+
+            with contextlib.closing(sqlite3.connect(snapshot)) as connection:
+                assert connection.execute("SELECT version FROM migrations").fetchall()
+
+            self.connection_manager.get('snapshot_queue').execute("DELETE FROM message_logs")
+            self.connection_manager.close()
+            self.connection_manager.restore(snapshot)
+            self.connection_manager.reconnect()
+            message_log, = brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+                'snapshot_queue', 'task')
+            assert message_log.message == '{"number": 1}'
+
+    def test_memory_snapshot_from_other_thread(self, tmpdir):
+        snapshot = str(tmpdir.join('brokkoly.db'))
+        self.connection_manager.dbname = brokkoly.database.MEMORY
+        with unittest.mock.patch.object(brokkoly.database, 'db', self.connection_manager):
+            brokkoly.database.Migrator(brokkoly.__version__).migrate()
+            self.connection_manager.reconnect()
+            brokkoly.database.MessageLog.create('snapshot_queue', 'task', '{"number": 1}')
+            self.connection_manager.get().commit()
+
+            errors = []
+
+            def take_snapshot():
+                try:
+                    self.connection_manager.snapshot(snapshot)
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=take_snapshot)
+            thread.start()
+            thread.join()
+            assert not errors
+            with contextlib.closing(sqlite3.connect(snapshot)) as connection:
+                assert connection.execute("SELECT * FROM message_logs").fetchall()
+
+            with unittest.mock.patch('os.replace', side_effect=OSError):
+                with pytest.raises(OSError):
+                    self.connection_manager.snapshot(snapshot)
+            assert [path.basename for path in tmpdir.listdir()] == ['brokkoly.db']
+
+    def test_memory_concurrent_writes(self):
+        self.connection_manager.dbname = brokkoly.database.MEMORY
+        with unittest.mock.patch.object(brokkoly.database, 'db', self.connection_manager):
+            brokkoly.database.Migrator(brokkoly.__version__).migrate()
+            self.connection_manager.reconnect()
+            brokkoly.database.MessageLog.create('queue', 'task', '{"number": 1}')
+
+            errors = []
+
+            def write():
+                self.connection_manager.reconnect()
+                try:
+                    brokkoly.database.MessageLog.create('queue', 'task', '{"number": 2}')
+                    self.connection_manager.get().commit()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    self.connection_manager.close()
+
+            # The writer waits for the uncommitted transaction instead of failing.
+            thread = threading.Thread(target=write)
+            thread.start()
+            time.sleep(0.1)
+            self.connection_manager.get().commit()
+            thread.join()
+            assert not errors
+            assert len(list(brokkoly.database.MessageLog.list_by_queue_name_and_task_name(
+                'queue', 'task'))) == 2
+
+
 class TestDBManager:
     def setup_method(self, method):
         self.mock_connection_manager = unittest.mock.MagicMock()